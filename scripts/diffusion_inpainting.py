@@ -133,7 +133,8 @@ def main():
         classifier.model.eval()
         with torch.no_grad():
             prediction = classifier.model(torch.tensor(sampled_data, dtype=torch.float64))
-            y = np.round(prediction.numpy().flatten())
+            # the classifier outputs logits, a logit > 0 is an anomaly
+            y = (prediction > 0).numpy().flatten()
             percentage_anomalies = y.mean()
         
         print(f"Percentage of anomalies in the generated samples: {percentage_anomalies:.2%}\n")
@@ -157,7 +158,8 @@ def main():
     y_after_classifier = None
     with torch.no_grad():
         prediction = classifier.model(torch.tensor(inpainted_data, dtype=torch.float64))
-        y_after_classifier = np.round(prediction.numpy().flatten()).astype(bool)
+        # the classifier outputs logits, a logit > 0 is an anomaly
+        y_after_classifier = (prediction > 0).numpy().flatten()
         percentage_anomalies_inpainted_classifier = y_after_classifier.mean()
     
     # Count the number of original anomalies
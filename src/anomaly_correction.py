@@ -1,3 +1,4 @@
+import logging
 import torch
 import pandas as pd
 import numpy as np
@@ -5,9 +6,13 @@ from src.datasets import DatabaseInterface
 from src.utils import Probabilities
 from src.inverse_gradient import InverseGradient
 
-# set default type to avoid problems with gradient
-DEFAULT_TYPE = torch.float64
-torch.set_default_dtype(DEFAULT_TYPE)
+# dtype of the tensors created by this module, the default dtype is left to the scripts,
+# single precision is enough for the gradient and it is the fast path on the GPU
+DEFAULT_TYPE = torch.float32
+DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+# the diagnostics of the correction are silenced by setting the level of this logger
+log = logging.getLogger('anomaly')
 
 
 class AnomalyCorrection:
@@ -55,6 +60,7 @@ class AnomalyCorrection:
         self.structure = self.interface.get_data_structure()
         self.proba = Probabilities(structure=self.structure)
         self.inv_grad = None
+        self.from_logits = False
 
         # model
         self.classification_model = None
@@ -65,9 +71,11 @@ class AnomalyCorrection:
         self._indices_to_proba()
         self._compute_noisy_proba()
 
-    def set_classification_model(self, model):
+    def set_classification_model(self, model, from_logits=False):
+        """set the classification model, from_logits is True if it outputs logits"""
         self.classification_model = model
-        self.inv_grad = InverseGradient(model)
+        self.from_logits = from_logits
+        self.inv_grad = InverseGradient(model, from_logits=from_logits)
 
     def set_diffusion(self, diffusion):
         """set diffusion"""
@@ -89,21 +97,20 @@ class AnomalyCorrection:
         """Convert the indices to noisy probabilities"""
         self.p_data = self.proba.to_onehot(self.v_data.to_numpy())
 
-    def _anomaly_to_proba(self, df, dtype=DEFAULT_TYPE):
+    def _anomaly_to_proba(self, df, dtype=DEFAULT_TYPE, device=DEVICE):
         self.anomaly_indices = self.interface.convert_values_to_indices(df).to_numpy()
-        self.anomaly_p = self.proba.to_onehot(self.anomaly_indices)
-        self.anomaly_p = torch.tensor(self.anomaly_p, dtype=dtype)
+        self.anomaly_p = self.proba.to_onehot(torch.from_numpy(self.anomaly_indices).to(device)).to(dtype)
         return self.anomaly_p
 
     def _compute_noisy_proba(self):
         """add noise to probabilities"""
         self.p_data_noisy = self.proba.add_noise(self.p_data)
 
-    def get_classification_dataset(self, dtype=DEFAULT_TYPE):
+    def get_classification_dataset(self, dtype=DEFAULT_TYPE, device=DEVICE):
         """Return the noisy probabilities and the anomaly labels"""
         x = self.p_data_noisy
         y = self.y.to_numpy().reshape(-1, 1).astype(float)
-        return torch.tensor(x, dtype=dtype), torch.tensor(y, dtype=dtype)
+        return torch.tensor(x, dtype=dtype, device=device), torch.tensor(y, dtype=dtype, device=device)
 
     def get_diffusion_dataset(self):
         """Return the dataset for the diffusion phase
@@ -113,15 +120,12 @@ class AnomalyCorrection:
 
     def _inverse_gradient(self, p, n, eta=0.01, n_iter=100, threshold_p=0.1):
         """
-        Modify p_anomaly one-by-one using the inverse gradient method
+        Modify n noisy copies of p_anomaly in a single batch using the inverse gradient method
         """
-        masks = []
-        new_values = []
-        for _ in range(n):
-            p_ = self.proba.add_noise(p, k=self.noise)
-            results = self.inv_grad.run(p_, self.structure, eta=eta, n_iter=n_iter, threshold_p=threshold_p)
-            masks.append(results["mask"])
-            new_values.append(results["values"])
+        p_batch = self.proba.add_noise(p, k=self.noise, n=n)
+        results = self.inv_grad.run(p_batch, self.structure, eta=eta, n_iter=n_iter, threshold_p=threshold_p)
+        masks = list(results["mask"])
+        new_values = list(results["values"])
         return masks, new_values
 
     def correct_anomaly(self, anomaly: pd.DataFrame, n, eta=0.01, n_iter=100, threshold_p=0.1):
@@ -136,10 +140,10 @@ class AnomalyCorrection:
         # print('\nanomaly_indices')
         # print(self.anomaly_indices)
 
-        print('\nmasks')
+        log.debug('masks')
         for mask in masks:
-            print(f'{mask}  ({len(mask)})')
-        print(len(masks))
+            log.debug('%s  (%d)', mask, len(mask))
+        log.debug('%d masks', len(masks))
 
         # print('\nstructure')
         # print(self.proba.structure)
@@ -156,6 +160,27 @@ class AnomalyCorrection:
 
         return new_values
     
+    def correct_anomalies(self, anomalies: pd.DataFrame, n, eta=0.01, n_iter=100, threshold_p=0.1):
+        """Correct several anomalies together
+        The n noisy copies of all the anomalies go through a single inverse gradient run and a single inpainting.
+        returns: list with a DataFrame of n corrected values for each anomaly
+        """
+        assert type(anomalies) is pd.DataFrame
+        assert self.classification_model is not None, 'Please set the classification model'
+        assert self.diffusion is not None, 'Please set the diffusion model'
+
+        p = self._anomaly_to_proba(anomalies)
+        masks, _ = self._inverse_gradient(p, n, eta=eta, n_iter=n_iter, threshold_p=threshold_p)
+
+        # the noisy copies are stacked along the first dimension, row j is a copy of anomaly j % len(anomalies)
+        anomaly_indices = np.tile(self.anomaly_indices, (n, 1))
+        new_indices = self.diffusion.inpaint(anomaly_indices=anomaly_indices, masks=masks, proba=self.proba)
+
+        # group the n corrections of each anomaly
+        new_indices = new_indices.reshape(n, len(anomalies), -1).transpose(1, 0, 2)
+        new_values = self.interface.convert_indices_to_values(new_indices.reshape(len(anomalies) * n, -1))
+        return [new_values.iloc[i * n:(i + 1) * n].reset_index(drop=True) for i in range(len(anomalies))]
+
     def assessment(self, corrected_anomalies_per_mask: list):
         """Assess the quality of the corrected anomalies"""
         assert type(corrected_anomalies_per_mask) is list
@@ -166,7 +191,10 @@ class AnomalyCorrection:
             print(corrected_anomalies)
             p = self._anomaly_to_proba(corrected_anomalies)
             # print(p)
-            y = self.classification_model(p).detach().numpy().flatten()
+            y = self.classification_model(p).detach()
+            if self.from_logits:
+                y = torch.sigmoid(y)
+            y = y.cpu().numpy().flatten()
             y = np.round(y)
             
             means_anomalies_not_corrected.append(np.mean(y))
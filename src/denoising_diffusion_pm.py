@@ -3,12 +3,15 @@ import os
 import numpy as np
 import pandas as pd
 import copy
+import pickle
 import wandb
 from tqdm import tqdm
 import torch
 import torch.nn as nn
+import torch.distributed as dist
 from torch import optim
-from torch.utils.data import TensorDataset, DataLoader
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import TensorDataset, DataLoader, DistributedSampler
 from safetensors.torch import save_model as safe_save_model
 from safetensors.torch import load_model as safe_load_model
 
@@ -38,8 +41,12 @@ class DDPM:
         self.scheduler.send_to_device(self.device) 
         self.dataset_shape = dataset_shape
         self.model = None        
+        # arguments of set_model, they are saved with the parameters to rebuild the model
+        self.model_config = None
         self.ema_model = None
         self.conditional_training = False
+        # torch.compile version of self.model, it is reused by training, sampling and inpainting
+        self._compiled_model = None
 
     def set_model(self, time_dim_emb=128,
                  num_classes=None,
@@ -47,9 +54,18 @@ class DDPM:
                  hidden_units: list | None=None, 
                  concat_x_and_t=False,
                  unet=False,
-                 dropout_rate=0.01):
+                 dropout_rate=0.01,
+                 fused_blocks=False):
         """Create a new noise predictor model with the provided parameters."""
         print('Creating a new diffusion model...')
+        self.model_config = {'time_dim_emb': time_dim_emb,
+                             'num_classes': num_classes,
+                             'feed_forward_kernel': feed_forward_kernel,
+                             'hidden_units': hidden_units,
+                             'concat_x_and_t': concat_x_and_t,
+                             'unet': unet,
+                             'dropout_rate': dropout_rate,
+                             'fused_blocks': fused_blocks}
         self.model = NoisePredictor(dataset_shape=self.dataset_shape,
                             time_dim_emb=time_dim_emb,
                             num_classes=num_classes,
@@ -57,10 +73,31 @@ class DDPM:
                             hidden_units=hidden_units,
                             concat_x_and_t=concat_x_and_t,
                             dropout_rate=dropout_rate,
-                            unet=unet 
+                            unet=unet,
+                            max_time_steps=self.scheduler.noise_time_steps,
+                            fused_blocks=fused_blocks
                             )
         
-    def train(self, dataloader, learning_rate=1e-3, epochs=64, beta_ema=0.999, wandb_track=False):
+    def _get_compiled_model(self, compile_mode='reduce-overhead'):
+        """
+        Compiled version of the forward and backward passes, it shares the parameters with self.model.
+        The shapes are fixed, so the graphs are static and (on the GPU) replayed with CUDA graphs.
+        With fullgraph, the forward pass is a single graph, a graph break raises an error instead of
+        splitting the denoising step in several graphs.
+        The compiled model is cached and only rebuilt if self.model or the mode change.
+        """
+        compiled = self._compiled_model
+        if compiled is None or compiled[0] is not self.model or compiled[1] != compile_mode:
+            self._compiled_model = (self.model, compile_mode,
+                                    torch.compile(self.model, mode=compile_mode, dynamic=False, fullgraph=True))
+        return self._compiled_model[2]
+
+    def _time_steps(self, samples):
+        """Time steps of the denoising loop, row i has shape (samples,) and is filled with i"""
+        return torch.arange(self.scheduler.noise_time_steps, device=self.device).unsqueeze(1).expand(-1, samples).contiguous()
+
+    def train(self, dataloader, learning_rate=1e-3, epochs=64, beta_ema=0.999, wandb_track=False, script=False,
+              compile_model=False, compile_mode='reduce-overhead', amp=False, distributed=False):
         # Instantiate the Exponential Moving Average (EMA) class
         ema = EMA(beta_ema)
         
@@ -68,6 +105,9 @@ class DDPM:
         assert dataloader is not None, 'Dataloader not provided'
         assert self.model is not None, 'Model not provided'
         assert isinstance(self.model, NoisePredictor), 'Model must be an instance of NoisePredictor'
+        assert not (script and compile_model), 'The model can be either scripted or compiled'
+        assert not distributed or dist.is_initialized(), 'The process group must be initialized for distributed training'
+        assert not (distributed and (script or compile_model)), 'The distributed model can not be scripted or compiled'
         
         if ema is not None:
             # copy the model and set it to evaluation mode
@@ -84,6 +124,14 @@ class DDPM:
         # set the model to training mode
         self.model.train()
         
+        # TorchScript version of the forward pass, it shares the parameters with self.model
+        # the backward pass is still computed by autograd
+        model = torch.jit.script(self.model) if script else self.model
+        
+        # the compilation overhead only pays off for large datasets, so it is disabled by default
+        if compile_model:
+            model = self._get_compiled_model(compile_mode)
+        
         print('Training the DDPM...')
         
         # Initialize list to store losses during training
@@ -92,13 +140,30 @@ class DDPM:
         # verify if the dataloader has labels
         self.conditional_training = True if len(dataloader.dataset[0]) == 2 else False
         
+        # with distributed, each process trains a replica on its shard of the data and the gradients are all-reduced,
+        # the EMA model is updated from the parameters of self.model, that are the same in all the processes
+        if distributed:
+            device_ids = [torch.cuda.current_device()] if self.device.type == 'cuda' else None
+            # without labels the label embedding of a conditional model is not used
+            model = DistributedDataParallel(model, device_ids=device_ids,
+                                            find_unused_parameters=self.conditional_training)
+        
+        # with amp, the forward pass runs in bfloat16 where it is safe, the parameters stay in float32
+        autocast = torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=amp)
+        
         # run the training loop
-        pbar = tqdm(range(epochs))
+        pbar = tqdm(range(epochs), disable=distributed and dist.get_rank() != 0)
         for epoch in pbar:
             
             running_loss = 0.0
             num_elements = 0
             
+            # a different shuffling of the shards at every epoch
+            # the DeviceDataLoader has no sampler
+            sampler = getattr(dataloader, 'sampler', None)
+            if isinstance(sampler, DistributedSampler):
+                sampler.set_epoch(epoch)
+            
             for batch_data in dataloader:  # x_{0} ~ q(x_{0})
                 optimizer.zero_grad()
                 
@@ -106,12 +171,12 @@ class DDPM:
                 
                 if self.conditional_training:
                     batch_samples, labels = batch_data
-                    labels = labels.to(self.device)
+                    labels = labels.to(self.device, non_blocking=True)
                 else:
                     batch_samples = batch_data[0]
                     labels = None
                     
-                batch_samples = batch_samples.to(self.device)
+                batch_samples = batch_samples.to(self.device, non_blocking=True)
                 
                 # t ~ U(1, T)
                 t = torch.randint(0, self.scheduler.noise_time_steps, (batch_samples.shape[0],)).to(self.device)
@@ -141,10 +206,11 @@ class DDPM:
                 # x_t = x_t.float()
                 # t = t.int()
 
-                predicted_noise = self.model(x_t, t, labels)
+                with autocast:
+                    predicted_noise = model(x_t, t, labels)
                 
-                # compare the noise and predicted noise with loss metric
-                loss = criterion(noise, predicted_noise)
+                    # compare the noise and predicted noise with loss metric
+                    loss = criterion(noise, predicted_noise)
                 loss.backward()
                 optimizer.step()
                 
@@ -167,15 +233,22 @@ class DDPM:
     
         return train_losses
 
-    @torch.no_grad()
-    def sample(self, samples, with_labels=False, num_classes=None, cfg_strength=3):
-        """Sampling method according to the DDPM paper."""
+    @torch.inference_mode()
+    def sample(self, samples, with_labels=False, num_classes=None, cfg_strength=3, compile_model=False,
+               compile_mode='reduce-overhead', amp=False):
+        """Sampling method according to the DDPM paper.
+        With compile_model, the noise_time_steps calls of the model go through the compiled model.
+        With amp, the model runs in bfloat16 autocast, the scheduler updates stay in the dtype of the samples.
+        It runs in inference mode, the returned tensors are inference tensors.
+        """
         
         assert self.model is not None, 'Model not provided'
         assert isinstance(self.model, NoisePredictor), 'Model must be an instance of NoisePredictor'
         
         self.model.eval()
         self.model.to(self.device)
+        model = self._get_compiled_model(compile_mode) if compile_model else self.model
+        autocast = torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=amp)
         
         if self.conditional_training:
             assert with_labels and num_classes is not None, 'The number of classes in the labels must be specified'
@@ -190,19 +263,22 @@ class DDPM:
         
         # x_{T} ~ N(0, I)
         x = torch.randn((samples, *self.dataset_shape[1:])).to(self.device)
-        ones = torch.ones(samples)
+        # the time steps of all the iterations are created on the device once
+        time_steps = self._time_steps(samples)
         # for t = T, T-1, ..., 1 (-1 in Python)
         pbar = tqdm(reversed(range(self.scheduler.noise_time_steps)))
         for i in pbar:
             
-            t = (ones * i).long().to(self.device)
-            predicted_noise = self.model(x, t, labels)
+            t = time_steps[i]
+            with autocast:
+                predicted_noise = model(x, t, labels)
             
             # Classifier-Free Guidance Sampling
             # The C-FG paper uses a conditional model to sample the noise
             if self.conditional_training:
                 if labels is not None:
-                    uncond_predicted_noise = self.model(x, t, None)
+                    with autocast:
+                        uncond_predicted_noise = model(x, t, None)
                     # interpolate between conditional and unconditional noise
                     # C-FG paper formula:
                     predicted_noise = (1 + cfg_strength) * predicted_noise - cfg_strength * uncond_predicted_noise
@@ -218,8 +294,9 @@ class DDPM:
             return [x, labels]
         return [x]
 
-    @torch.no_grad()
-    def inpaint(self, original, mask, resampling_steps=10):
+    @torch.inference_mode()
+    def inpaint(self, original, mask, resampling_steps=10, compile_model=False, compile_mode='reduce-overhead',
+                amp=False):
         """Inpainting method according to the RePaint paper."""
         # ?: implement time jumps for inpainting
         
@@ -231,6 +308,8 @@ class DDPM:
         
         self.model.eval()
         self.model.to(self.device)
+        model = self._get_compiled_model(compile_mode) if compile_model else self.model
+        autocast = torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=amp)
         
         original = original.to(self.device)
         mask = mask.to(self.device)
@@ -240,22 +319,23 @@ class DDPM:
         # x_{T} ~ N(0, I)
         x_t = torch.randn_like(original).to(self.device)
         x_t_minus_one = torch.randn_like(x_t)
-        ones = torch.ones(x_t.shape[0])
+        time_steps = self._time_steps(x_t.shape[0])
         
         # for t = T, T-1, ..., 1 (-1 in Python)
         pbar = tqdm(reversed(range(self.scheduler.noise_time_steps)))
         for i in pbar:
             
+            t = time_steps[i]
             for u in range(resampling_steps):
-                t = (ones * i).long().to(self.device)
                 
                 # epsilon = N(0, I) if t > 1 else 0
-                forward_noise = torch.randn_like(x_t) if t[0] > 0 else torch.zeros_like(x_t)
+                forward_noise = torch.randn_like(x_t) if i > 0 else torch.zeros_like(x_t)
                 
                 # differs from the algorithm in the paper but doesn't matter because of stochasticity
                 x_known = self.scheduler.add_noise(original, forward_noise, t)
 
-                predicted_noise = self.model(x_t, t)
+                with autocast:
+                    predicted_noise = model(x_t, t)
                 x_unknown = self.scheduler.sample_prev_step(x_t, predicted_noise, t)
                 
                 # The mask is the opposite of the paper, they changed their notation and was published like that
@@ -288,7 +368,8 @@ class DDPM:
                                     feed_forward_kernel=feed_forward_kernel, 
                                     hidden_units=hidden_units,
                                     concat_x_and_t=concat_x_and_t,
-                                    unet=unet).to(self.device)
+                                    unet=unet,
+                                    max_time_steps=self.scheduler.noise_time_steps).to(self.device)
         
             filename = path + filename + '.safetensors'
             self.model = safe_load_model(self.model, filename)
@@ -297,16 +378,26 @@ class DDPM:
             self.model = None
     
     def load_model_pickle(self, filename, path="../models/"):
-        """Load model parameters from a file using pickle."""
+        """Load model parameters from a file using pickle.
+        The file holds the state dict and the config of the model, so only tensors are unpickled
+        and the model is rebuilt with the current code.
+        """
         print(f'\nLoading a DDPM model...')
         try:
             filename = path + filename + '.pkl'
-            model = torch.load(filename)
-            assert isinstance(model, NoisePredictor), 'Model must be an instance of NoisePredictor'
-            self.model = model
+            checkpoint = torch.load(filename, map_location=self.device, weights_only=True)
+            # the model is rebuilt in the default dtype, the parameters of a checkpoint saved in
+            # another dtype (e.g. float64) are cast when they are copied by load_state_dict
+            self.set_model(**checkpoint['config'])
+            self.model.load_state_dict(checkpoint['state_dict'])
         except FileNotFoundError:
             print('Model not found')
             self.model = None
+        except pickle.UnpicklingError:
+            # a whole pickled NoisePredictor keeps the attributes and the dtype of the code that saved it,
+            # a float64 one would fail on the float32 inputs of the scripts
+            print('Model saved in an old format, it is not loaded and must be retrained')
+            self.model = None
         
     def save_model_safetensors(self, filename, ema_model=True, path="../models/"):
         """
@@ -325,14 +416,15 @@ class DDPM:
         print(f'Model saved in {filename}')
 
     def save_model_pickle(self, filename, ema_model=True, path="../models/"):
-        """Save the model using pickle."""
+        """Save the state dict and the config of the model using pickle."""
         if not os.path.exists(path):
             os.makedirs(path)
         filename = path + filename + '.pkl'
+        # the EMA model is a copy of self.model, so it has the same config
         if ema_model and self.ema_model is not None:
-            torch.save(self.ema_model, filename)
+            torch.save({'state_dict': self.ema_model.state_dict(), 'config': self.model_config}, filename)
         elif self.model is not None:
-            torch.save(self.model, filename)
+            torch.save({'state_dict': self.model.state_dict(), 'config': self.model_config}, filename)
 
 
 class DDPMAnomalyCorrection(DDPM):
@@ -351,7 +443,12 @@ class DDPMAnomalyCorrection(DDPM):
               plot_data=False,
               proba=None,
               original_data_name='ddpm_original_data',
-              wandb_track=False):
+              wandb_track=False,
+              script=False,
+              compile_model=False,
+              compile_mode='reduce-overhead',
+              amp=False,
+              distributed=False):
         
         assert proba is not None, 'The structure must be provided'
         assert isinstance(dataset, pd.DataFrame), 'The dataset must be a pandas DataFrame'
@@ -359,15 +456,22 @@ class DDPMAnomalyCorrection(DDPM):
         
         if plot_data:
             plot_categories(x_indices, proba.structure, original_data_name, save_locally=plot_data) 
-        x_logits_tensor = torch.tensor(proba.values_to_logits(x_indices), dtype=torch.float64)
+        x_logits_tensor = torch.tensor(proba.values_to_logits(x_indices), dtype=torch.get_default_dtype())
         tensor_dataset =  TensorDataset(x_logits_tensor)
-        dataloader = DataLoader(tensor_dataset, batch_size=batch_size, shuffle=True)
+        # with distributed, each process iterates over its own shard of the dataset
+        sampler = DistributedSampler(tensor_dataset) if distributed else None
+        dataloader = DataLoader(tensor_dataset, batch_size=batch_size, shuffle=sampler is None, sampler=sampler)
         
         loss = super().train(dataloader=dataloader,
                              learning_rate=learning_rate,
                              epochs=epochs,
                              beta_ema=beta_ema,
-                             wandb_track=wandb_track)
+                             wandb_track=wandb_track,
+                             script=script,
+                             compile_model=compile_model,
+                             compile_mode=compile_mode,
+                             amp=amp,
+                             distributed=distributed)
         
         return loss
         
@@ -376,11 +480,16 @@ class DDPMAnomalyCorrection(DDPM):
                plot_data=False,
                proba=None,
                sampled_data_name='ddpm_sampled_data',
+               from_logits=False,
+               compile_model=False,
+               compile_mode='reduce-overhead',
+               amp=False,
                ):
         
         assert proba is not None, 'The probabilities object must be provided'
         
-        sampled_logits = super().sample(samples=num_samples)[0]
+        sampled_logits = super().sample(samples=num_samples, compile_model=compile_model,
+                                        compile_mode=compile_mode, amp=amp)[0]
 
         x_indices_sampled = proba.logits_to_values(sampled_logits.cpu().numpy())
             
@@ -391,8 +500,11 @@ class DDPMAnomalyCorrection(DDPM):
             return {'x': x_indices_sampled}
         else:
             p_sampled = proba.logits_to_proba(sampled_logits.cpu().numpy())
-            p_sampled = torch.tensor(p_sampled)
-            y = classifier(p_sampled).detach().numpy().flatten()
+            p_sampled = torch.tensor(p_sampled, dtype=torch.get_default_dtype(), device=self.device)
+            y = classifier(p_sampled).detach()
+            if from_logits:
+                y = torch.sigmoid(y)
+            y = y.cpu().numpy().flatten()
             y = np.round(y)
             
             print(f'\nPercentage anomalies generated {np.mean(y):.1%}')
@@ -403,22 +515,29 @@ class DDPMAnomalyCorrection(DDPM):
                 masks,
                 proba=None,
                 resampling_steps=10,
+                compile_model=False,
+                compile_mode='reduce-overhead',
+                amp=False,
                 ):
         
         assert proba is not None, 'The probabilities object must be provided'
 
         # Convert the indices data to logits
-        x_logits = torch.tensor(proba.values_to_logits(anomaly_indices), dtype=torch.float64)
+        x_logits = torch.tensor(proba.values_to_logits(anomaly_indices), dtype=torch.get_default_dtype())
 
-        inpainted_indices = []
-        for mask in masks:
-            mask = np.repeat(mask, np.array(proba.structure), axis=0)
-            mask = torch.tensor(mask)
-            x_inpainted_logits = super().inpaint(original=x_logits,
-                                                 mask=mask,
-                                                 resampling_steps=resampling_steps)
-            inpainted_indices.append(proba.logits_to_values(x_inpainted_logits.cpu().numpy()))
+        # all the masks are inpainted together in a single batch,
+        # the anomalies are either one row shared by all the masks or one row per mask
+        masks = np.asarray(masks, dtype=bool)
+        assert x_logits.shape[0] in (1, len(masks)), 'One anomaly or one anomaly per mask must be provided'
+        mask = torch.from_numpy(masks[:, proba.expand_idx])
+        x_logits = x_logits.expand(len(masks), -1)
 
-        inpainted_indices = np.array(inpainted_indices).squeeze(1)
+        x_inpainted_logits = super().inpaint(original=x_logits,
+                                             mask=mask,
+                                             resampling_steps=resampling_steps,
+                                             compile_model=compile_model,
+                                             compile_mode=compile_mode,
+                                             amp=amp)
+        inpainted_indices = proba.logits_to_values(x_inpainted_logits.cpu().numpy())
 
         return inpainted_indices
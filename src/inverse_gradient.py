@@ -4,58 +4,70 @@ The algorithm is used to correct anomalies in a dataset by using the inverse gra
 """
 import numpy as np
 import torch
-from copy import deepcopy
+import torch.nn.functional as F
 from src.utils import cprint, bcolors, Probabilities
 
 
 class InverseGradient:
     """ Author: Omar
     Bare-bones inverse gradient method
+    If from_logits is True, the model outputs logits instead of probabilities
     """
-    def __init__(self, model):
+    def __init__(self, model, from_logits=False):
         self.model = model
+        self.from_logits = from_logits
         self._p_copy = None
         self._module = None
 
-    def _compute_p_copy(self, p, proba, eta):
-        """ Update probabilities by maintaining normalization """
-        self._p_copy = p.detach().clone()
+    @torch.no_grad()
+    def _compute_p_copy(self, p, proba, eta, active, zero_gradient):
+        """ Update probabilities by maintaining normalization
+        The samples with a zero gradient can't move, they are marked in zero_gradient and stopped
+        """
         dp = -p.grad
-        self._module = np.linalg.norm(dp.numpy().flatten())
-        if self._module == 0:
-            raise ZeroDivisionError
-        dp = dp / self._module * eta
-        self._p_copy += dp
-        self._p_copy = proba.normalize(self._p_copy)
-
-    def run(self, p: torch.tensor, structure: tuple, eta=0.01, n_iter=100, threshold_p=0.1):
+        # one norm per row, so every sample takes a step of size eta
+        self._module = torch.linalg.vector_norm(dp, dim=-1, keepdim=True)
+        zero = active & (self._module.squeeze(-1) == 0)
+        zero_gradient |= zero
+        active &= ~zero
+        dp.mul_(eta / self._module.clamp_min(1e-12))
+        # the samples that are already corrected are not modified
+        dp[~active] = 0
+        self._p_copy = proba.normalize(p.detach() + dp)
+
+    def run(self, p: torch.tensor, structure: tuple, eta=0.01, n_iter=100, threshold_p=0.1, verbose: int = 50,
+            check_every: int = 20):
         """
         Given a classifier and a set of data points, modify the data points
         so that the classification changes from 1 to 0.
+        The data points are modified together, each one stops as soon as it is corrected.
 
         params:
-        p: torch.tensor, the data point to modify
+        p: torch.tensor, the data points to modify, with shape (n, sum(structure))
         structure: tuple, the number of values for each feature
         eta: float, the step size for the gradient descent
         n_iter: int, the maximum number of iterations
         threshold: float, the threshold probability for the loss function
+        verbose: int, the number of iterations between progress prints
+        check_every: int, the number of iterations between the checks of the stopping criteria
         """
         assert self.model is not None
-        assert p.shape[0] == 1
         assert len(p.shape) == 2
 
         assert 0 < eta < 1
         assert 0 < threshold_p < 1
 
-        p_ = deepcopy(p)
+        p_ = p.detach().clone()
         proba = Probabilities(structure)
-        v_old = proba.onehot_to_values(p_)[0]
+        v_old = proba.onehot_to_values(p_.cpu())
         v_new = v_old.copy()
         mask = v_new == v_new
-        success = True
+        active = torch.ones(p_.shape[0], dtype=torch.bool, device=p_.device)
+        zero_gradient = torch.zeros_like(active)
+        target = torch.zeros((p_.shape[0], 1), dtype=p_.dtype, device=p_.device)
 
         # add gaussian noise to the input
-        p_.requires_grad = True
+        p_.requires_grad_(True)
 
         i = 0
         while True:
@@ -63,49 +75,60 @@ class InverseGradient:
 
             # Make the prediction
             y = self.model(p_)
-            p_anomaly = y[0][0]
 
-            # Compute the loss
-            loss = torch.nn.BCELoss()(y, torch.zeros_like(y))
+            # Compute the loss, summed so that the gradients of the rows are independent
+            if self.from_logits:
+                loss = F.binary_cross_entropy_with_logits(y, target, reduction='sum')
+                p_anomaly = torch.sigmoid(y[:, 0].detach())
+            else:
+                loss = F.binary_cross_entropy(y, target, reduction='sum')
+                p_anomaly = y[:, 0]
 
             # Compute the gradient of the loss with respect to x
             loss.backward()
 
+            # the checks synchronize with the device, so they are not done at every iteration,
+            # the first one is at the first iteration, so the samples already corrected stop there
+            check = (i - 1) % check_every == 0 or i == n_iter
+
             # Create a copy of x and update the copy
-            try:
-                self._compute_p_copy(p_, proba, eta)
-            except ZeroDivisionError:
-                # check if the gradient is zero
-                cprint('Warning: Gradient is zero', bcolors.WARNING)
-                success = False
-                break
+            self._compute_p_copy(p_, proba, eta, active, zero_gradient)
 
             # Update the original x with the modified copy
             p_.data = self._p_copy
 
             # Clear the gradient for the next iteration
-            p_.grad.zero_()
-
-            # Check if v_new is different to v_old
-            v_new = proba.onehot_to_values(p_.detach().numpy())[0]
-            mask = v_old != v_new
-            changed = np.any(mask)
-
-            # check if the loss is below the threshold
-            print(f'\rIteration {i+1}, pred {p_anomaly:.1%}', end=' ')
-            if p_anomaly < threshold_p:
-                if changed:
-                    cprint(f'\rIteration {i}) loss is {p_anomaly:.1%} < {threshold_p:.1%}', bcolors.OKGREEN)
+            p_.grad = None
+
+            if i % verbose == 0:
+                print(f'\rIteration {i+1}, pred {p_anomaly.max():.1%}', end=' ')
+
+            if check:
+                # Check if v_new is different to v_old
+                v_new = proba.onehot_to_values(p_.detach().cpu().numpy())
+                mask = v_old != v_new
+                changed = torch.from_numpy(np.any(mask, axis=1)).to(active.device)
+
+                # check if the loss is below the threshold
+                active &= ~((p_anomaly < threshold_p) & changed)
+                if not torch.any(active):
+                    # check if the gradient is zero
+                    n_zero = int(zero_gradient.sum())
+                    if n_zero:
+                        cprint(f'\rIteration {i}) Warning: Gradient is zero ({n_zero}/{len(active)} samples)',
+                               bcolors.WARNING)
+                    else:
+                        cprint(f'\rIteration {i}) pred is < {threshold_p:.1%} for all the samples', bcolors.OKGREEN)
                     break
 
             # check if the maximum number of iterations is reached
             if i == n_iter:
-                cprint(f'Warning: Maximum iterations reached ({p_anomaly:.1%})', bcolors.WARNING)
-                success = False
+                cprint(f'Warning: Maximum iterations reached ({int(active.sum())}/{len(active)} not corrected)',
+                       bcolors.WARNING)
                 break
 
         return {"values": v_new,
                 "mask": mask,
                 "proba": p_,
                 "anomaly_p": p_anomaly,
-                "success": success}
+                "success": (~active & ~zero_gradient).cpu().numpy()}
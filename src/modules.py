@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from typing import Optional, Final
 from abc import ABC, abstractmethod
 
 
@@ -15,18 +16,29 @@ class BaseArchitectureKernel(nn.Module, ABC):
 
 
 class FeedForwardKernel(BaseArchitectureKernel):
-    def __init__(self, input_dim, output_dim, hidden_units: list, dropout_rate=0.01):
+    def __init__(self, input_dim, output_dim, hidden_units: list, dropout_rate=0.01, fused_blocks=False):
         super().__init__(input_dim, output_dim)
         
         layers = [] 
-        layers.append(nn.Linear(input_dim, hidden_units[0]))
-        layers.append(nn.ReLU())
-        layers.append(nn.Dropout(dropout_rate))
-        for i in range(len(hidden_units)-1):
-            layers.append(nn.Linear(hidden_units[i], hidden_units[i+1]))
+        if fused_blocks:
+            # The narrow hidden layers are dominated by the kernel launches,
+            # thus they are replaced by a single wide hidden layer with the same number of parameters
+            units = [input_dim] + list(hidden_units) + [output_dim]
+            num_params = sum((units[i] + 1) * units[i+1] for i in range(len(units)-1))
+            width = max(1, round((num_params - output_dim) / (input_dim + 1 + output_dim)))
+            layers.append(nn.Linear(input_dim, width))
+            layers.append(nn.SiLU())
+            layers.append(nn.Dropout(dropout_rate))
+            layers.append(nn.Linear(width, output_dim))
+        else:
+            layers.append(nn.Linear(input_dim, hidden_units[0]))
             layers.append(nn.ReLU())
             layers.append(nn.Dropout(dropout_rate))
-        layers.append(nn.Linear(hidden_units[-1], output_dim))
+            for i in range(len(hidden_units)-1):
+                layers.append(nn.Linear(hidden_units[i], hidden_units[i+1]))
+                layers.append(nn.ReLU())
+                layers.append(nn.Dropout(dropout_rate))
+            layers.append(nn.Linear(hidden_units[-1], output_dim))
         
         self.net = nn.Sequential(*layers)
         
@@ -38,7 +50,9 @@ class NoisePredictor(nn.Module):
     """
     Neural network for the noise predictor in DDPM.
     """
-    
+    __constants__ = ['_needs_unsqueeze']
+    _needs_unsqueeze: Final[bool]
+
     def __init__(self, dataset_shape=None,
                  time_dim_emb=128,
                  num_classes=None,
@@ -46,7 +60,9 @@ class NoisePredictor(nn.Module):
                  hidden_units: list | None=None, 
                  concat_x_and_t=False,
                  dropout_rate=0.01,
-                 unet=False):
+                 unet=False,
+                 max_time_steps=1024,
+                 fused_blocks=False):
         super().__init__()
         
         assert dataset_shape is not None, 'The dataset shape must be provided'
@@ -62,6 +78,9 @@ class NoisePredictor(nn.Module):
         self.time_dim_emb = time_dim_emb
         self.dataset_shape = dataset_shape
         self.concat_x_and_t = concat_x_and_t
+        # the time embedding has shape (batch_size, columns), so it only has to be
+        # broadcast when the samples have shape (batch_size, rows, columns)
+        self._needs_unsqueeze = len(dataset_shape) == 3
         
         input_dim = dataset_shape[1]
         if concat_x_and_t:
@@ -76,7 +95,8 @@ class NoisePredictor(nn.Module):
         ) if not concat_x_and_t else nn.Identity()
         
         if feed_forward_kernel:
-            self.architecture_kernel = FeedForwardKernel(input_dim, dataset_shape[1], hidden_units, dropout_rate=dropout_rate)
+            self.architecture_kernel = FeedForwardKernel(input_dim, dataset_shape[1], hidden_units,
+                                                         dropout_rate=dropout_rate, fused_blocks=fused_blocks)
         elif unet:
             self.architecture_kernel = UNet1ChannelKernel(input_dim, dataset_shape[1], concat_x_and_t)
         else:
@@ -86,9 +106,14 @@ class NoisePredictor(nn.Module):
         # It encode the labels into the time dimension
         # It is used to condition the model
         self.num_classes = num_classes
-        if num_classes is not None:
-            self.label_emb = nn.Embedding(num_classes, time_dim_emb)  # label_emb(labels) has shape (batch_size, time_dim_emb)
-            
+        # label_emb(labels) has shape (batch_size, time_dim_emb)
+        self.label_emb = nn.Embedding(num_classes, time_dim_emb) if num_classes is not None else None
+
+        # The time steps are integers in [0, max_time_steps), so the positional encoding
+        # is computed once for all of them and indexed in the forward pass
+        time_steps = torch.arange(max_time_steps).unsqueeze(-1).to(torch.get_default_dtype())
+        self.register_buffer('pos_enc', self.positional_encoding(time_steps), persistent=False)
+
     def positional_encoding(self, time_steps):
         r"""
         Sinusoidal positional encoding for the time steps.
@@ -106,9 +131,9 @@ class NoisePredictor(nn.Module):
         """
         inv_freq = 1.0 / (10000 ** (torch.arange(0, self.time_dim_emb, 2) / self.time_dim_emb)).to(time_steps.device)
         pos_enc = torch.cat([torch.sin(time_steps * inv_freq), torch.cos(time_steps * inv_freq)], dim=-1)
-        return pos_enc.to(torch.float64)
+        return pos_enc.to(time_steps.dtype)
 
-    def forward(self, x_t, t, y=None):
+    def forward(self, x_t, t, y: Optional[torch.Tensor] = None):
         """
         The goal is to predict the noise for the diffusion model
         The architecture input is: x_{t} and t, which could be summed
@@ -119,30 +144,26 @@ class NoisePredictor(nn.Module):
         """
         
         # Positional encoding for the time steps
-        # t.shape (batch_size,1) -> (batch_size) -> (batch_size, time_dim_emb)
-        t = self.positional_encoding(t.unsqueeze(-1).to(torch.float64))
+        # t.shape (batch_size) -> (batch_size, time_dim_emb)
+        t = self.pos_enc[t.long()]
         
         # Label embedding
         if y is not None:
-            assert self.num_classes is not None, 'The number of classes must be provided'
+            assert self.label_emb is not None, 'The number of classes must be provided'
             # y has shape (batch_size, 1) 0 -> (batch_size)
             y = y.squeeze(-1).long()
-            t += self.label_emb(y)
+            t = t + self.label_emb(y)
             # label_emb(y) has shape (batch_size, time_dim_emb)
             # the sum is element-wise
         
         # Time embedding
         # t has shape (batch_size, time_dim_emb)
-        emb = self.time_emb_layer(t).to(torch.float64)  # emb has shape (batch_size, ...) if concat_x_and_t is False
-        # emb is of datatype float = torch.float32
+        emb = self.time_emb_layer(t).to(x_t.dtype)  # emb has shape (batch_size, ...) if concat_x_and_t is False
+        # emb has the same datatype as x_t
         
-        # Cases for broadcasting emb to match x_t
-        if x_t.dim() == emb.dim():
-            pass
-        else:
-            for _ in range(x_t.dim() - 2):
-                emb = emb.unsqueeze(-1).expand_as(x_t)  # emb has shape (batch_size, ...)
-                # emb = emb.unsqueezep[:, :, None].repeat(1, 1, x_t.shape[-1])
+        # Broadcasting emb to match x_t
+        if self._needs_unsqueeze:
+            emb = emb.unsqueeze(-1).expand_as(x_t)  # emb has shape (batch_size, ...)
         
         # Application of transformation layers
         # torch layers work better with float32
@@ -4,7 +4,7 @@ The algorithm is used to correct anomalies in a dataset by using the inverse gra
 """
 import numpy as np
 import torch
-from copy import deepcopy
+import torch.nn.functional as F
 from src.utils import cprint, bcolors, Probabilities
 
 
@@ -14,8 +14,10 @@ class InverseGradient:
     by using the inverse gradient algorithm.
     """
     def __init__(self, x: torch.tensor, y: torch.tensor, model_name: str):
-        self.x = x
-        self.y = y
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # the data is moved to the device once, instead of at every epoch
+        self.x = x.to(self.device).contiguous()
+        self.y = y.to(self.device).contiguous()
         self.model_name = model_name
         self.model = None
         self._p_copy = None
@@ -27,7 +29,8 @@ class InverseGradient:
         name = self.get_model_name()
         try:
             cprint(f'Loading model from {name}', bcolors.WARNING)
-            self.model = torch.load(name)
+            self.model = torch.load(name, map_location=self.device)
+            self.model.to(self.device)
             cprint('Model loaded', bcolors.OKGREEN)
         except FileNotFoundError:
             cprint('Model not found', bcolors.FAIL)
@@ -36,21 +39,18 @@ class InverseGradient:
         """Get the model name"""
         return self.model_name
 
-    def _training_loop(self, loss_fn, n_epochs, lr=0.1, weight_decay=1e-3, momentum=0.9, nesterov=True):
+    def _training_loop(self, loss_fn, n_epochs, optimizer, scheduler, print_every=50):
         """training loop"""
-        # optimizer
-        optimizer = torch.optim.SGD(self.model.parameters(), lr=lr,
-                                    weight_decay=weight_decay, momentum=momentum,
-                                    nesterov=nesterov)
-
-        # training loop
         for epoch in range(n_epochs):
             y_pred = self.model(self.x)
             loss = loss_fn(y_pred, self.y)
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             loss.backward()
             optimizer.step()
-            print(f'\rlr={lr}, Epoch {epoch+1}, Loss {loss.item():.6f}', end=' ')
+            scheduler.step()
+            # loss.item() synchronizes with the device, so it is not called at every epoch
+            if (epoch + 1) % print_every == 0:
+                print(f'\rlr={scheduler.get_last_lr()[0]:.3g}, Epoch {epoch+1}, Loss {loss.item():.6f}', end=' ')
         print()
 
     def training(self, n_epochs=1000, lr=0.1, weight_decay=1e-3, momentum=0.9, nesterov=True):
@@ -61,18 +61,24 @@ class InverseGradient:
         loss_fn = torch.nn.BCELoss()
 
         # test the model
-        y_pred = self.model(self.x)
+        with torch.no_grad():
+            y_pred = self.model(self.x)
         loss = loss_fn(y_pred, self.y)
         print(f'Initial Loss {loss.item():.3f}')
 
+        # optimizer
+        optimizer = torch.optim.SGD(self.model.parameters(), lr=lr,
+                                    weight_decay=weight_decay, momentum=momentum,
+                                    nesterov=nesterov)
+        # n_epochs at lr, then n_epochs at lr/10, keeping the momentum buffers
+        scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=n_epochs, gamma=0.1)
+
         # training
-        self._training_loop(loss_fn, n_epochs, lr=lr, weight_decay=weight_decay,
-                            momentum=momentum, nesterov=nesterov)
-        self._training_loop(loss_fn, n_epochs, lr=lr/10, weight_decay=weight_decay,
-                            momentum=momentum, nesterov=nesterov)
+        self._training_loop(loss_fn, 2 * n_epochs, optimizer, scheduler)
 
         # test the model
-        y_pred = self.model(self.x)
+        with torch.no_grad():
+            y_pred = self.model(self.x)
         loss = loss_fn(y_pred, self.y)
         print(f'Final Loss {loss.item():.6f}')
 
@@ -91,7 +97,7 @@ class InverseGradient:
         print(f'Dummy accuracy = {dummy_acc:.1%}')
         print(f'Accuracy on test data = {acc:.1%}')
         cprint(f'usefulness = {usefulness:.1%}', color)
-        rmse = torch.sqrt(torch.mean((y_pred - self.y) ** 2))
+        rmse = F.mse_loss(y_pred, self.y).sqrt()
         print(f'RMSE on test data {rmse.item():.3f}')
 
         # save the model
@@ -100,12 +106,12 @@ class InverseGradient:
     def _compute_p_copy(self, p, proba, eta):
         self._p_copy = p.detach().clone()
         dp = - p.grad
-        self._module = np.linalg.norm(dp.numpy().flatten())
+        self._module = torch.linalg.vector_norm(dp)
         dp = dp / self._module * eta
         self._p_copy += dp
         self._p_copy = proba.normalize(self._p_copy)
 
-    def run(self, x, structure, eta=0.01, n_iter=100, threshold=0.1):
+    def run(self, x, structure, eta=0.01, n_iter=100, threshold=0.1, check_every=20):
         """
         Given a classifier and a set of data points, modify the data points
         so that the classification changes from 1 to 0.
@@ -116,18 +122,20 @@ class InverseGradient:
         eta: float, the step size for the gradient descent
         n_iter: int, the maximum number of iterations
         threshold: float, the threshold probability for the loss function
+        check_every: int, the number of iterations between the checks of the stopping criteria
         """
         assert self.model is not None
         assert x.shape[0] == 1
         assert 0 < eta < 1
         assert 0 < threshold < 1
 
-        p = deepcopy(x)
+        p = x.detach().to(self.device).clone()
         proba = Probabilities(structure)
-        v_old = proba.onehot_to_values(p)[0]
+        v_old = proba.onehot_to_values(p.cpu())[0]
 
         # add gaussian noise to the input
-        p.requires_grad = True
+        p.requires_grad_(True)
+        target = torch.zeros((p.shape[0], 1), dtype=p.dtype, device=p.device)
 
         i = 0
         while True:
@@ -137,7 +145,7 @@ class InverseGradient:
             y = self.model(p)
 
             # Compute the loss
-            loss = torch.nn.BCELoss()(y, torch.zeros_like(y))
+            loss = F.binary_cross_entropy(y, target)
 
             # Compute the gradient of the loss with respect to x
             loss.backward()
@@ -149,10 +157,15 @@ class InverseGradient:
             p.data = self._p_copy
 
             # Clear the gradient for the next iteration
-            p.grad.zero_()
+            p.grad = None
+
+            # the checks synchronize with the device, so they are not done at every iteration,
+            # the first one is at the first iteration, so an anomaly already corrected stops there
+            if (i - 1) % check_every != 0 and i != n_iter:
+                continue
 
             # Check if v_new is different to v_old
-            v_new = proba.onehot_to_values(p.detach().numpy())[0]
+            v_new = proba.onehot_to_values(p.detach().cpu().numpy())[0]
             changed = np.any(v_old != v_new)
 
             # check if the loss is below the threshold
@@ -1,12 +1,18 @@
 import os
+import pickle
+from dataclasses import dataclass
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.colors import ListedColormap
+from matplotlib.patches import Patch
 import wandb
 from tqdm import tqdm
 from abc import ABC, abstractmethod
 import torch
 from torch.utils.data import DataLoader, TensorDataset, random_split
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
 import seaborn as sns
 import pandas as pd
@@ -15,25 +21,103 @@ from sklearn.preprocessing import StandardScaler
 # from imblearn.over_sampling import SMOTE
 
 
+@dataclass(frozen=True)
+class DatasetBatch:
+    """
+    Batch with the fields of the dataset returned by generate_dataset.
+    The DataLoader pins custom batch types only through their pin_memory method.
+    """
+    x: torch.Tensor
+    y: torch.Tensor
+    indices: torch.Tensor
+
+    def pin_memory(self):
+        return type(self)(x=self.x.pin_memory(), y=self.y.pin_memory(), indices=self.indices.pin_memory())
+
+    def to(self, device, non_blocking=False):
+        return type(self)(x=self.x.to(device, non_blocking=non_blocking),
+                          y=self.y.to(device, non_blocking=non_blocking),
+                          indices=self.indices.to(device, non_blocking=non_blocking))
+
+
+def collate_dataset_batch(samples):
+    """collate_fn that stacks (x, y, indices) samples into a DatasetBatch"""
+    x, y, indices = zip(*samples)
+    return DatasetBatch(x=torch.stack(x), y=torch.stack(y), indices=torch.stack(indices))
+
+
 class BaseDataset(ABC):
     def __init__(self):
         self.dataset = None
+        # logits of the whole dataset, they are filtered by generate_dataset
+        self._x_cache = None
+        self._x_cache_eps = None
+        # index encoded dataset, it does not depend on the arguments of generate_dataset
+        self._x_indices_t = None
+        self._y_t = None
 
     @abstractmethod
     def generate_dataset(self):
         pass
 
-    def get_dataloader(self, batch_size=64, shuffle=True, with_labels=False):
-        """Generate a dataloader for the dataset."""
+    def _indices_dataset(self):
+        """Return the whole dataset in index space, the tensors are built once."""
+        if self._x_indices_t is None:
+            self._x_indices_t = torch.from_numpy(self.row_x_indices_np.astype(np.float64))
+            self._y_t = torch.from_numpy(self.row_y_np.astype(np.float64)[:, None])
+        return {'x': self._x_indices_t, 'y': self._y_t}
+
+    @staticmethod
+    def _make_dataloader(dataset, batch_size, shuffle, num_workers, pin_memory, persistent_workers,
+                         collate_fn=None):
+        """DataLoader with pinned memory and persistent workers when they are available."""
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
+                          num_workers=num_workers,
+                          pin_memory=pin_memory and torch.cuda.is_available(),
+                          persistent_workers=persistent_workers and num_workers > 0,
+                          collate_fn=collate_fn)
+
+    def get_batch_dataloader(self, batch_size=64, shuffle=True, num_workers=2, pin_memory=True,
+                             persistent_workers=True):
+        """Generate a dataloader whose batches are DatasetBatch objects with x, y and indices."""
+        if self.dataset is None:
+            self.generate_dataset()
+
+        tensor_dataset = TensorDataset(self.dataset['x'], self.dataset['y'], self.dataset['indices'])
+        return self._make_dataloader(tensor_dataset, batch_size, shuffle,
+                                     num_workers, pin_memory, persistent_workers,
+                                     collate_fn=collate_dataset_batch)
+
+    def get_dataloader(self, batch_size=64, shuffle=True, num_workers=2, pin_memory=True, persistent_workers=True,
+                       with_labels=False, device=None):
+        """Generate a dataloader for the dataset.
+        If a device is provided, the dataset is moved to it once and the batches are sliced there.
+        """
         if self.dataset is None:
             self.generate_dataset()
 
         if with_labels:
-            tensor_dataset = TensorDataset(self.dataset['x'], self.dataset['y'])
+            tensors = (self.dataset['x'], self.dataset['y'])
         else:
-            tensor_dataset = TensorDataset(self.dataset['x'])
+            tensors = (self.dataset['x'],)
 
-        return DataLoader(tensor_dataset, batch_size=batch_size, shuffle=shuffle)
+        if device is not None:
+            tensor_dataset = TensorDataset(*[t.to(device, non_blocking=True) for t in tensors])
+            return DeviceDataLoader(tensor_dataset, batch_size=batch_size, shuffle=shuffle)
+
+        return self._make_dataloader(TensorDataset(*tensors), batch_size, shuffle,
+                                     num_workers, pin_memory, persistent_workers)
+
+    @staticmethod
+    def _select_rows(keep, *tensors):
+        """Select the rows where keep is True, the row indices are computed once for all the tensors"""
+        keep_idx = torch.from_numpy(np.flatnonzero(keep))
+        return [t.index_select(0, keep_idx) for t in tensors]
+
+    @staticmethod
+    def _indices_dtype(structure):
+        """Smallest integer type that holds the label encoded values"""
+        return np.int8 if max(structure) < 128 else np.int32
 
     def get_dataset_shape(self):
         assert self.dataset is not None, 'Dataset not generated'
@@ -44,6 +128,61 @@ class BaseDataset(ABC):
         pass
 
 
+class DeviceDataLoader:
+    """
+    Iterate over a TensorDataset that already lives on the device.
+    It replaces the DataLoader for the small datasets that fit in the device memory,
+    since there are no host to device copies per batch.
+    """
+    def __init__(self, tensor_dataset, batch_size=64, shuffle=True):
+        self.dataset = tensor_dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.device = tensor_dataset.tensors[0].device
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        n = len(self.dataset)
+        indices = torch.randperm(n, device=self.device) if self.shuffle else torch.arange(n, device=self.device)
+        for i in range(0, n, self.batch_size):
+            batch_indices = indices[i:i + self.batch_size]
+            yield [t[batch_indices] for t in self.dataset.tensors]
+
+
+# classification datasets smaller than this are trained full-batch
+FULL_BATCH_LIMIT = 4096
+
+
+def train_classifier(model, x, y, optimizer, loss_fn, n_epochs, batch_size=100, verbose=50):
+    """
+    Training loop of the example classifiers.
+    The datasets smaller than FULL_BATCH_LIMIT are trained full-batch, the others in shuffled mini-batches
+    gathered on the device of x. The loss is accumulated on the device, it is only synchronized when printed
+    """
+    if x.shape[0] < FULL_BATCH_LIMIT:
+        batch_size = x.shape[0]
+    loader = DeviceDataLoader(TensorDataset(x, y), batch_size=batch_size, shuffle=True)
+
+    for epoch in range(n_epochs):
+        total_loss = torch.zeros((), device=x.device)
+        for batch_x, batch_y in loader:
+            y_pred = model(batch_x)
+            loss = loss_fn(y_pred, batch_y)
+
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+
+            total_loss += loss.detach()
+
+        if (epoch + 1) % verbose == 0:
+            avg_loss = (total_loss / len(loader)).item()
+            print(f'\rEpoch {epoch + 1}, Loss {avg_loss:.6f}', end=' ')
+    print()
+
+
 class CategoricalEncoder:
     """Class for encoding and decoding categorical values in a DataFrame."""
     def __init__(self, data):
@@ -51,18 +190,22 @@ class CategoricalEncoder:
         self.map_categories_to_indices = {}
         self.map_indices_to_categories = {}
         self.columns_names = []
+        self.uniques = []       # sorted values of each column, indexed by the codes
+        self.codes = None       # encoded data
         self.data = data
         
         self._encode_dataset()
 
     def _encode_dataset(self):
         """Encode a DataFrame of categorical values."""
+        self.codes = np.empty(self.data.shape, dtype=np.int32)
         for i, column in enumerate(self.data.columns):
             self.columns_names.append(column)
-            unique_values = self.data[column].unique().tolist()
-            self.structure.append(len(unique_values))
-            unique_values.sort()
-            indices_encoding = {val: idx for idx, val in enumerate(unique_values)}
+            codes, uniques = pd.factorize(self.data[column], sort=True)
+            self.codes[:, i] = codes
+            self.uniques.append(np.asarray(uniques))
+            self.structure.append(len(uniques))
+            indices_encoding = {val: idx for idx, val in enumerate(self.uniques[i])}
             self.map_categories_to_indices[i] = indices_encoding
             self.map_indices_to_categories[i] = {idx: val for val, idx in indices_encoding.items()}
 
@@ -72,16 +215,14 @@ class CategoricalEncoder:
 
     def indices_to_dataframe(self, indices):
         """Decode a 2D array of numerical labels to a DataFrame with the original values."""
-        decoded_values = self.decode_indices(indices)
-        decoded_df = pd.DataFrame(decoded_values, columns=self.columns_names)
+        indices = np.asarray(indices, dtype=np.int64)
+        decoded_df = pd.DataFrame({column: self.uniques[i][indices[:, i]]
+                                   for i, column in enumerate(self.columns_names)})
         return decoded_df
     
     def encoded_data(self):
         """Return the encoded data."""
-        encoded_data = self.data.copy()
-        for i, column in enumerate(self.data.columns):
-            encoded_data[column] = self.data[column].map(self.map_categories_to_indices[i])
-        return encoded_data.to_numpy()
+        return self.codes
 
 
 class RealDataset(BaseDataset):
@@ -107,7 +248,7 @@ class RealDataset(BaseDataset):
         encoder = LabelEncoder()
         encoder.fit(y)
         y = encoder.transform(y)
-        self.row_y_np = y.astype(np.bool)
+        self.row_y_np = y.astype(bool, copy=False)
         
         # Extract the structure of the data with a categorical encoder
         self.categorical_encoder = CategoricalEncoder(x)
@@ -115,13 +256,14 @@ class RealDataset(BaseDataset):
         
         # Transform the data to probabilities representation
         self.proba = Probabilities(structure)
-        self.row_x_indices_np = self.categorical_encoder.encoded_data()
+        self.row_x_indices_np = self.categorical_encoder.encoded_data().astype(self._indices_dtype(structure))
     
     def get_degrees_of_freedom_categories(self):
         """Return the sum of number of values for each category."""
         return sum(self.proba.structure)
     
-    def get_classifier_dataloader(self, training_prop=0.7, batch_size=64, shuffle=True):
+    def get_classifier_dataloader(self, training_prop=0.7, batch_size=64, shuffle=True,
+                                  num_workers=2, pin_memory=True, persistent_workers=True):
         """Generate a dataloader for the dataset."""
         dataset = self.generate_dataset(indices=True)
         
@@ -142,7 +284,8 @@ class RealDataset(BaseDataset):
         # Split the dataset into training and validation sets
         train_dataset, _ = random_split(tensor_dataset, [train_size, val_size])
         
-        return DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle)
+        return self._make_dataloader(train_dataset, batch_size, shuffle,
+                                     num_workers, pin_memory, persistent_workers)
     
     def generate_dataset(self, remove_anomalies=False, only_anomalies=False, indices=False, eps=1e-6):
         """
@@ -150,38 +293,37 @@ class RealDataset(BaseDataset):
         """
         assert not (remove_anomalies and only_anomalies), 'Cannot remove and keep only anomalies at the same time'
         
-        x_indices = torch.tensor(self.row_x_indices_np, dtype=torch.float64)
+        # the indices stay integers, they are only cast when used as features
+        x_indices = torch.from_numpy(self.row_x_indices_np)
         y = self.row_y_np
         
         if not (remove_anomalies or only_anomalies) and indices:
-            x = x_indices
-            y = np.expand_dims(y, axis=1)
-            y = torch.tensor(y, dtype=torch.float64) 
-            return {'x': x, 'y': y}
+            return self._indices_dataset()
         
-        x = self.proba.to_onehot(self.row_x_indices_np)
+        if self._x_cache is None or self._x_cache_eps != eps:
+            # one-hot encoding computed with torch, without the float64 NumPy intermediate
+            x = self.proba.to_onehot(torch.from_numpy(self.row_x_indices_np)).to(torch.float64)
+            # fused logit, the one-hot values are clamped to [eps, 1 - eps]
+            self._x_cache = torch.logit(x, eps=eps)
+            self._x_cache_eps = eps
+        x = self._x_cache
         
         # Remove anomalies if needed for DDPM training
         if remove_anomalies:
             print('Removing anomalies')
-            x = x[~y]
-            x_indices = x_indices[~y]
+            x, x_indices = self._select_rows(~y, x, x_indices)
             y = y[~y]
             
         # Get only anomalies if needed for anomaly detection
         elif only_anomalies:
-            x = x[y]
-            x_indices = x_indices[y]
+            x, x_indices = self._select_rows(y, x, x_indices)
             y = y[y]
 
         y = np.expand_dims(y, axis=1)
 
         # convert to torch tensors
-        x = torch.tensor(x, dtype=torch.float64)
         y = torch.tensor(y, dtype=torch.bool)
 
-        x = torch.log((x + eps) / (1 - x + eps))
-
         self.dataset = {'x': x, 'y': y, 'indices': x_indices}
 
         return self.dataset
@@ -235,15 +377,16 @@ class SumCategoricalDataset(BaseDataset):
         # Generate raw data
         p = np.random.random(size=(size, sum(structure)))
         self.probabilities = self.proba.normalize(p)
+        self._x_cache = None
+        self._x_indices_t = None
 
-        # Convert probabilities to onehot encoding
-        x = self.proba.prob_to_onehot(p)
-        
-        self.row_x_indices_np = self.proba.onehot_to_values(x)
+        # the values are the argmax of each feature, without building the one-hot encoding
+        self.row_x_indices_np = self.proba.onehot_to_values(p).astype(self._indices_dtype(structure))
         # Generate labels based on the threshold
         self.row_y_np = np.sum(self.row_x_indices_np, axis=1) > self.threshold
     
-    def get_classifier_dataloader(self, training_prop=0.7, batch_size=64, shuffle=True):
+    def get_classifier_dataloader(self, training_prop=0.7, batch_size=64, shuffle=True,
+                                  num_workers=2, pin_memory=True, persistent_workers=True):
         """Generate a dataloader for the dataset."""
         dataset = self.generate_dataset(indices=True)
         
@@ -259,7 +402,8 @@ class SumCategoricalDataset(BaseDataset):
         # Split the dataset into training and validation sets
         train_dataset, _ = random_split(tensor_dataset, [train_size, val_size])
         
-        return DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle)
+        return self._make_dataloader(train_dataset, batch_size, shuffle,
+                                     num_workers, pin_memory, persistent_workers)
 
     def generate_dataset(self, remove_anomalies=False, only_anomalies=False, indices=False, eps=1e-6):
         """
@@ -269,31 +413,28 @@ class SumCategoricalDataset(BaseDataset):
         
         assert not (remove_anomalies and only_anomalies), 'Cannot remove and keep only anomalies at the same time'
         
-        x_indices = torch.tensor(self.row_x_indices_np, dtype=torch.float64)
+        # the indices stay integers, they are only cast when used as features
+        x_indices = torch.from_numpy(self.row_x_indices_np)
         y = self.row_y_np
         if not (remove_anomalies or only_anomalies) and indices:
-            x = x_indices
-            y = np.expand_dims(y, axis=1)
-            y = torch.tensor(y, dtype=torch.float64) 
-            return {'x': x, 'y': y}
+            return self._indices_dataset()
         
-        x = self.probabilities
+        if self._x_cache is None or self._x_cache_eps != eps:
+            # fused logit, the probabilities are clamped to [eps, 1 - eps]
+            self._x_cache = torch.logit(torch.tensor(self.probabilities, dtype=torch.float64), eps=eps)
+            self._x_cache_eps = eps
+        x = self._x_cache
         
         if remove_anomalies:
-            x = x[~y]
-            x_indices = x_indices[~y]
+            x, x_indices = self._select_rows(~y, x, x_indices)
             y = y[~y]
         elif only_anomalies:
-            x = x[y]
-            x_indices = x_indices[y]
+            x, x_indices = self._select_rows(y, x, x_indices)
             y = y[y]
         
         y = np.expand_dims(y, axis=1)
-        x = torch.tensor(x, dtype=torch.float64)
         y = torch.tensor(y, dtype=torch.float64)
         
-        x = torch.log((x + eps) / (1 - x + eps))
-        
         self.dataset = {'x': x, 'y': y, 'indices': x_indices}
         
         return self.dataset
@@ -354,26 +495,22 @@ class SumCategoricalDataset(BaseDataset):
                 [False, True,  False, False, True,  False, False,  True]])
         """
 
-        # Fetch the label values
+        # Fetch the label values (zero-copy view, the rows match the generated dataset)
         array = self.dataset['indices'].numpy()
 
-        # Calculate the sum of each row
-        row_sums = np.sum(array, axis=1)
-
-        # Create a boolean array to store the result
-        result = np.zeros_like(array, dtype=bool)
-
         # Identify rows where the sum exceeds the threshold
-        exceeding_rows_indices = np.where(row_sums > self.threshold)[0]
+        mask_rows = np.sum(array, axis=1) > self.threshold
 
-        if exceeding_rows_indices.size > 0:
-            # Find the index of the maximum value in the rows that exceed the threshold
-            max_value_indices = np.argmax(array[exceeding_rows_indices], axis=1)
-            result[exceeding_rows_indices, max_value_indices] = True
+        # Find the index of the maximum value in every row,
+        # only the rows that exceed the threshold are marked
+        max_value_indices = np.argmax(array, axis=1)
+        result = np.zeros_like(array, dtype=bool)
+        result[np.arange(array.shape[0]), max_value_indices] = mask_rows
 
         # Repeat each column according to the specified repetition counts
-        repeated_result = np.repeat(result, self.proba.structure, axis=1)
-        repeated_result = torch.tensor(repeated_result, dtype=torch.bool)
+        repeated_result = result[:, self.proba.expand_idx]
+        # the tensor shares the memory of the NumPy mask
+        repeated_result = torch.from_numpy(np.ascontiguousarray(repeated_result))
 
         if label_values_mask:
             return [repeated_result, result]
@@ -394,27 +531,21 @@ class SumCategoricalDataset(BaseDataset):
                 [False, True,  True]])
         """
 
-        # Fetch the label values 
+        # Fetch the label values (zero-copy view, the rows match the generated dataset)
         array = self.dataset['indices'].numpy()
 
-        # Calculate the sum of each row
-        row_sums = np.sum(array, axis=1)
-
         # Identify rows where the sum exceeds the threshold
-        exceed_threshold = row_sums > self.threshold
-
-        # Identify the maximum value in each row
-        row_maxes = np.max(array, axis=1)
-
-        # For each row, create a boolean array where True indicates that the element is the maximum
-        is_max = array == row_maxes[:, None]
+        exceed_threshold = np.flatnonzero(np.sum(array, axis=1) > self.threshold)
 
-        # Combine the conditions: the sum exceeds the threshold and the element is the maximum
-        result = np.logical_and(exceed_threshold[:, None], is_max)
+        # the maximum is only looked for in those rows, the other rows stay False
+        result = np.zeros(array.shape, dtype=bool)
+        rows = array[exceed_threshold]
+        result[exceed_threshold] = rows == np.max(rows, axis=1, keepdims=True)
 
-        repeated_result = np.repeat(result, self.proba.structure, axis=1)
+        repeated_result = result[:, self.proba.expand_idx]
 
-        repeated_result = torch.tensor(repeated_result, dtype=torch.bool)
+        # the tensor shares the memory of the NumPy mask
+        repeated_result = torch.from_numpy(np.ascontiguousarray(repeated_result))
 
         if label_values_mask:
             return [repeated_result, result]
@@ -430,24 +561,18 @@ class GaussianDataset(BaseDataset):
     def __init__(self):
         super().__init__()
 
-    def _generate_samples(self, mean, cov, num_samples):
+    @staticmethod
+    def _transform_matrix(cov_tensor):
         """
-        Generates samples using an alternative approach to handle non-positive definite covariance matrices.
+        Matrix L such that L @ L.T = cov_tensor.
+        The Cholesky factor is used for positive definite matrices,
+        the eigendecomposition for the positive semi-definite ones.
         """
-        mean_tensor = torch.tensor(mean, dtype=torch.float64)
-        cov_tensor = torch.tensor(cov, dtype=torch.float64)
-
-        # Ensure the covariance matrix is symmetric
-        cov_tensor = (cov_tensor + cov_tensor.T) / 2
-
-        # Use SVD to generate samples
-        U, S, V = torch.svd(cov_tensor)
-        transform_matrix = U @ torch.diag(torch.sqrt(S))
-
-        normal_samples = torch.randn(num_samples, len(mean), dtype=torch.float64)
-        samples = normal_samples @ transform_matrix.T + mean_tensor
-
-        return samples
+        try:
+            return torch.linalg.cholesky(cov_tensor)
+        except RuntimeError:
+            vals, vecs = torch.linalg.eigh(cov_tensor)
+            return vecs * torch.sqrt(torch.clamp(vals, min=0)).unsqueeze(-2)
 
     def generate_dataset(self, means, covariances, num_samples_per_distribution, labels=None):
         """
@@ -471,18 +596,27 @@ class GaussianDataset(BaseDataset):
         assert len(means) == len(covariances) == len(num_samples_per_distribution) == len(labels), \
             "The lengths of means, covariances, num_samples_per_distribution, and labels must be the same."
 
-        samples = []
-        labels_list = []
-
-        for mean, cov, num_samples, label in zip(means, covariances, num_samples_per_distribution, labels):
-            samples_i = self._generate_samples(mean, cov, num_samples)
-            labels_i = torch.full((num_samples, 1), label)
-            samples.append(samples_i)
-            labels_list.append(labels_i)
-
-        # Concatenate all samples and labels
-        x_tensor = torch.cat(samples, dim=0)
-        y_tensor = torch.cat(labels_list, dim=0)
+        # Stack the parameters of all the distributions
+        means_tensor = torch.stack([torch.as_tensor(mean, dtype=torch.float64) for mean in means])
+        covs_tensor = torch.stack([torch.as_tensor(cov, dtype=torch.float64) for cov in covariances])
+
+        # Ensure the covariance matrices are symmetric
+        covs_tensor = (covs_tensor + covs_tensor.transpose(-1, -2)) / 2
+
+        # All the distributions are sampled at once, each sample uses the parameters of its distribution
+        transform_matrices = self._transform_matrix(covs_tensor)
+        counts = torch.tensor(num_samples_per_distribution)
+        distribution_ids = torch.repeat_interleave(torch.arange(len(means)), counts)
+        dim = means_tensor.shape[1]
+        normal_samples = torch.randn(len(distribution_ids), dim, dtype=torch.float64)
+        if torch.all(counts == counts[0]):
+            # same number of samples per distribution: one batched matmul, without a matrix per sample
+            x_tensor = normal_samples.view(len(means), -1, dim) @ transform_matrices.transpose(-1, -2)
+            x_tensor = x_tensor.reshape(-1, dim)
+        else:
+            x_tensor = torch.einsum('ndj,nj->nd', transform_matrices[distribution_ids], normal_samples)
+        x_tensor = x_tensor + means_tensor[distribution_ids]
+        y_tensor = torch.as_tensor(labels)[distribution_ids].unsqueeze(1)
 
         self.dataset = {'x': x_tensor, 'y': y_tensor}
 
@@ -520,31 +654,49 @@ class GaussianDataset(BaseDataset):
         y = self.dataset['y'].numpy().flatten()
 
         unique_labels = np.unique(y)
-        plt.figure(figsize=(8, 6))
+        fig, ax = _reusable_figure('plot_data', figsize=(8, 6))
 
         for label in unique_labels:
             mask = y == label
-            plt.scatter(x[mask, 0], x[mask, 1], alpha=0.5, label=f'Labels {int(label)}')
+            ax.scatter(x[mask, 0], x[mask, 1], alpha=0.5, label=f'Labels {int(label)}')
 
-        plt.title('2D Gaussians')
-        plt.xlabel('X')
-        plt.ylabel('Y')
-        plt.legend()
-        plt.grid(True)
+        ax.set_title('2D Gaussians')
+        ax.set_xlabel('X')
+        ax.set_ylabel('Y')
+        ax.legend()
+        ax.grid(True)
 
         if save_wandb:
-            wandb.log({filename: wandb.Image(plt)})
+            wandb.log({filename: wandb.Image(fig)})
         if save_locally:
-            plt.savefig(path + filename + '.png')
+            fig.savefig(path + filename + '.png')
+
+
+# figures reused by the plot functions, they are outside of the pyplot registry
+# so they are not kept alive between calls and they do not need a GUI backend
+_FIGURES = {}
+
+
+def _reusable_figure(name, figsize=None):
+    """Return the cleared (fig, ax) pair associated to name, it is created at the first call"""
+    if name not in _FIGURES:
+        fig = Figure(figsize=figsize)
+        _FIGURES[name] = (fig, fig.add_subplot())
+    fig, ax = _FIGURES[name]
+    ax.clear()
+    return fig, ax
 
 def plot_generated_samples(samples, filename, save_locally=False, save_wandb=False, path="../plots/"):
     """ Author: Luis
     Save the plot of the generated samples in the plots folder and in the wandb dashboard.
     """
+    if not save_locally and not save_wandb:
+        return
+
     if not os.path.exists(path) and save_locally:
         os.makedirs(path)
 
-    fig = plt.figure()
+    fig, ax = _reusable_figure('plot_generated_samples')
     if len(samples) == 1:
         x = samples[0]
     else:
@@ -552,17 +704,17 @@ def plot_generated_samples(samples, filename, save_locally=False, save_wandb=Fal
     if len(samples) == 2:
         y = samples[1]
         mask = y == 1
-        plt.scatter(x[~mask, 0], x[~mask, 1], alpha=0.5, label='Normal')
-        plt.scatter(x[mask, 0], x[mask, 1], alpha=0.5, label='Anomaly')
-        plt.legend()
+        ax.scatter(x[~mask, 0], x[~mask, 1], alpha=0.5, label='Normal')
+        ax.scatter(x[mask, 0], x[mask, 1], alpha=0.5, label='Anomaly')
+        ax.legend()
     else:
-        plt.scatter(x[:, 0], x[:, 1], alpha=0.5)
-    plt.title(filename)
-    plt.xlabel('X')
-    plt.ylabel('Y')
+        ax.scatter(x[:, 0], x[:, 1], alpha=0.5)
+    ax.set_title(filename)
+    ax.set_xlabel('X')
+    ax.set_ylabel('Y')
 
     if save_locally:
-        plt.savefig(path + filename + '.png')
+        fig.savefig(path + filename + '.png')
     if save_wandb:
         wandb.log({filename: wandb.Image(fig)})
 
@@ -581,18 +733,18 @@ def plot_data_to_inpaint(x, mask, filename=None, save_locally=False, save_wandb=
     mask = mask.numpy().squeeze()
 
     # Scatter plot of the dataset
-    fig = plt.figure(figsize=(8, 6))
-    plt.scatter(x[~mask, 0], x[~mask, 1], alpha=0.5, label='Reference')
-    plt.scatter(x[mask, 0], x[mask, 1], alpha=0.5, label='Masked')
-    plt.title('Dataset with Mask')
-    plt.xlabel('X')
-    plt.ylabel('Y')
-    plt.legend()
+    fig, ax = _reusable_figure('plot_data_to_inpaint', figsize=(8, 6))
+    ax.scatter(x[~mask, 0], x[~mask, 1], alpha=0.5, label='Reference')
+    ax.scatter(x[mask, 0], x[mask, 1], alpha=0.5, label='Masked')
+    ax.set_title('Dataset with Mask')
+    ax.set_xlabel('X')
+    ax.set_ylabel('Y')
+    ax.legend()
 
     if save_locally:
         if not os.path.exists(path):
             os.makedirs(path)
-        plt.savefig(path + filename + '.png')
+        fig.savefig(path + filename + '.png')
     
     if save_wandb:
         wandb.log({filename: wandb.Image(fig)})
@@ -611,20 +763,16 @@ class EMA:
         assert beta < 1 and beta > 0, 'The beta EMA must in the range (0, 1)'
         self.step = 0
 
+    @torch.no_grad()
     def update_model_average(self, ma_model, current_model):
-        """updates the parameters of the model average"""
-        for current_params, ma_params in zip(current_model.parameters(), ma_model.parameters()):
-            old_weight, up_weight = ma_params.data, current_params.data
-            ma_params.data = self.update_average(old_weight, up_weight)
-
-    def update_average(self, old, new):
         """
-        core idea of EMA
-        the weights are an interpolation between the old and new weights weighted by beta
+        updates the parameters of the model average
+        the weights are an interpolation between the old and new weights weighted by beta,
+        applied to all the parameters with a single multi-tensor lerp
         """
-        if old is None:
-            return new
-        return old * self.beta + (1 - self.beta) * new
+        ma_params = [p.data for p in ma_model.parameters()]
+        current_params = [p.data for p in current_model.parameters()]
+        torch._foreach_lerp_(ma_params, current_params, 1 - self.beta)
 
     def step_ema(self, ema_model, model, step_start_ema=2000):
         # warmup phase
@@ -646,22 +794,54 @@ class EMA:
 
 def plot_loss(losses, filename, save_locally=False, save_wandb=False, path="../plots/"):
     """plot the loss and save it in the plots folder and in the wandb dashboard."""
-    if not os.path.exists(path):
+    if not save_locally and not save_wandb:
+        return
+
+    if not os.path.exists(path) and save_locally:
         os.makedirs(path)
 
-    fig = plt.figure()
-    plt.plot(losses)
-    plt.title('Training Loss')
-    plt.xlabel('Epoch')
-    plt.ylabel('Loss')
+    fig, ax = _reusable_figure('plot_loss')
+    ax.plot(losses)
+    ax.set_title('Training Loss')
+    ax.set_xlabel('Epoch')
+    ax.set_ylabel('Loss')
 
     if save_locally:
-        plt.savefig(path + filename + '.png')
+        fig.savefig(path + filename + '.png')
 
     if save_wandb:
         wandb.log({filename: wandb.Image(fig)})
 
 
+# TorchScript kernels of the scheduler updates
+# the gathers with t (index_select on the contiguous schedules) and the element-wise operations
+# are fused in a single graph
+
+@torch.jit.script
+def _add_noise_kernel(sqrt_alpha_bar, sqrt_one_minus_alpha_bar, x0, noise, t):
+    return sqrt_alpha_bar.index_select(0, t) * x0 + sqrt_one_minus_alpha_bar.index_select(0, t) * noise
+
+
+@torch.jit.script
+def _prev_mean_kernel(betas, alphas, sqrt_one_minus_alpha_bar, x_t, predicted_noise, t):
+    mean = x_t - (betas.index_select(0, t) * predicted_noise) / sqrt_one_minus_alpha_bar.index_select(0, t)
+    return mean / torch.sqrt(alphas.index_select(0, t))
+
+
+@torch.jit.script
+def _prev_step_kernel(betas, alphas, alpha_bar, sqrt_one_minus_alpha_bar, x_t, predicted_noise, t, backward_noise):
+    mean = _prev_mean_kernel(betas, alphas, sqrt_one_minus_alpha_bar, x_t, predicted_noise, t)
+    # t - 1 wraps around at t = 0 like negative indexing, the kernel is not used at that step
+    alpha_bar_t_minus_one = alpha_bar.index_select(0, torch.remainder(t - 1, alpha_bar.shape[0]))
+    std = (1.0 - alpha_bar_t_minus_one) / (1.0 - alpha_bar.index_select(0, t)) * betas.index_select(0, t)
+    return mean + std * backward_noise
+
+
+@torch.jit.script
+def _inpainting_resample_kernel(betas, alphas, x_t_minus_one, t, noise):
+    return x_t_minus_one * torch.sqrt(alphas.index_select(0, t)) + torch.sqrt(betas.index_select(0, t)) * noise
+
+
 class BaseNoiseScheduler(ABC):
     """ Author: Luis
     Base class for the noise scheduler in the diffusion model.
@@ -677,20 +857,62 @@ class BaseNoiseScheduler(ABC):
         self.alpha_bar = None
         self.sqrt_alpha_bar = None
         self.sqrt_one_minus_alpha_bar = None
+        # buffer refilled with the gaussian noise of the reverse steps, allocated at the first step
+        self._noise_buf = None
+        # copies of the add_noise schedules in the dtypes of the samples, e.g. bfloat16 in mixed precision
+        self._add_noise_schedules = {}
 
     @abstractmethod
     def _initialize_schedule(self):
         pass
 
+    def _set_schedule(self, betas, alphas, alpha_bar):
+        """
+        Set the scheduler parameters from the 1-D schedules.
+        They are reshaped once to broadcast with the samples and stored as contiguous tensors.
+        """
+        shape = [-1] + [1] * self.num_dims_to_add
+        self.betas = betas.reshape(shape).contiguous()
+        self.alphas = alphas.reshape(shape).contiguous()
+        self.alpha_bar = alpha_bar.reshape(shape).contiguous()
+        self.sqrt_alpha_bar = torch.sqrt(self.alpha_bar)
+        self.sqrt_one_minus_alpha_bar = torch.sqrt(1 - self.alpha_bar)
+        self._add_noise_schedules = {}
+
+    def _add_noise_schedule(self, dtype):
+        """
+        sqrt_alpha_bar and sqrt_one_minus_alpha_bar in the given dtype.
+        The copies are cached, so the samples are not upcast at every training step.
+        """
+        if dtype == self.sqrt_alpha_bar.dtype:
+            return self.sqrt_alpha_bar, self.sqrt_one_minus_alpha_bar
+        if dtype not in self._add_noise_schedules:
+            self._add_noise_schedules[dtype] = (self.sqrt_alpha_bar.to(dtype), self.sqrt_one_minus_alpha_bar.to(dtype))
+        return self._add_noise_schedules[dtype]
+
+    def _standard_noise(self, x):
+        """
+        z ~ N(0, I) with the shape of x, written in the same buffer at every step.
+        The kernels return new tensors, so the buffer can be reused at the next call.
+        A buffer created in inference mode can't be written outside of it, so it is reallocated.
+        """
+        buf = self._noise_buf
+        if (buf is None or buf.shape != x.shape or buf.dtype != x.dtype or buf.device != x.device
+                or buf.is_inference() != torch.is_inference_mode_enabled()):
+            buf = self._noise_buf = torch.empty_like(x)
+        return buf.normal_()
+
     def send_to_device(self, device):
         """
         Send the scheduler parameters to the device for efficient computation.
         """
-        self.betas = self.betas.to(device)
-        self.alphas = self.alphas.to(device)
-        self.alpha_bar = self.alpha_bar.to(device)
-        self.sqrt_alpha_bar = self.sqrt_alpha_bar.to(device)
-        self.sqrt_one_minus_alpha_bar = self.sqrt_one_minus_alpha_bar.to(device)
+        # contiguous, so that the gathers with t are single index_select kernels
+        self.betas = self.betas.to(device).contiguous()
+        self.alphas = self.alphas.to(device).contiguous()
+        self.alpha_bar = self.alpha_bar.to(device).contiguous()
+        self.sqrt_alpha_bar = self.sqrt_alpha_bar.to(device).contiguous()
+        self.sqrt_one_minus_alpha_bar = self.sqrt_one_minus_alpha_bar.to(device).contiguous()
+        self._add_noise_schedules = {}
 
     def add_noise(self, x0, noise, t):
         r"""
@@ -701,7 +923,8 @@ class BaseNoiseScheduler(ABC):
         t has shape (batch_size,)
         The scheduler parameters already have the correct shape to match x_{0} and noise.
         """
-        return self.sqrt_alpha_bar[t] * x0 + self.sqrt_one_minus_alpha_bar[t] * noise
+        sqrt_alpha_bar, sqrt_one_minus_alpha_bar = self._add_noise_schedule(x0.dtype)
+        return _add_noise_kernel(sqrt_alpha_bar, sqrt_one_minus_alpha_bar, x0, noise, t)
 
     def sample_prev_step(self, x_t, predicted_noise, t):
         r"""
@@ -709,15 +932,16 @@ class BaseNoiseScheduler(ABC):
         x_{t-1} ~ p_{\theta}(x_{t-1}|x_{t})
         """
 
-        # noise = z ~ N(0, I) if t > 1 else 0
-        backward_noise = torch.randn_like(x_t) if t[0] > 0 else torch.zeros_like(x_t)
+        # at the last step the noise is 0, so only the mean is computed
+        if t[0] == 0:
+            return _prev_mean_kernel(self.betas, self.alphas, self.sqrt_one_minus_alpha_bar, x_t, predicted_noise, t)
 
-        mean = x_t - (self.betas[t] * predicted_noise) / self.sqrt_one_minus_alpha_bar[t]
-        mean = mean / torch.sqrt(self.alphas[t])
-        std = (1.0 - self.alpha_bar[t - 1]) / (1.0 - self.alpha_bar[t]) * self.betas[t]
+        # noise = z ~ N(0, I)
+        backward_noise = self._standard_noise(x_t)
 
         # x_{t-1} = predicted_mean_reconstruction + fixed_std * noise
-        return mean + std * backward_noise
+        return _prev_step_kernel(self.betas, self.alphas, self.alpha_bar, self.sqrt_one_minus_alpha_bar,
+                                 x_t, predicted_noise, t, backward_noise)
 
     def sample_current_state_inpainting(self, x_t_minus_one, t):
         """
@@ -725,9 +949,9 @@ class BaseNoiseScheduler(ABC):
         """
 
         # noise = z ~ N(0, I)
-        noise = torch.randn_like(x_t_minus_one)
+        noise = self._standard_noise(x_t_minus_one)
 
-        return x_t_minus_one * torch.sqrt(self.alphas[t]) + torch.sqrt(self.betas[t]) * noise
+        return _inpainting_resample_kernel(self.betas, self.alphas, x_t_minus_one, t, noise)
         # return x_t_minus_one * torch.sqrt(self.alphas[t - 1]) + torch.sqrt(self.betas[t - 1]) * noise
 
 
@@ -746,13 +970,11 @@ class LinearNoiseScheduler(BaseNoiseScheduler):
         self.beta_end = beta_end
         self._initialize_schedule()
 
+    @torch.no_grad()
     def _initialize_schedule(self):
-        linspace = torch.linspace(self.beta_start, self.beta_end, self.noise_time_steps)  # note: Omar split this line
-        self.betas = linspace.view(*([-1] + [1] * self.num_dims_to_add))  # because it was too long
-        self.alphas = 1. - self.betas
-        self.alpha_bar = torch.cumprod(self.alphas, dim=0)
-        self.sqrt_alpha_bar = torch.sqrt(self.alpha_bar)
-        self.sqrt_one_minus_alpha_bar = torch.sqrt(1 - self.alpha_bar)
+        betas = torch.linspace(self.beta_start, self.beta_end, self.noise_time_steps)
+        alphas = 1. - betas
+        self._set_schedule(betas, alphas, torch.cumprod(alphas, dim=0))
 
 
 class CosineNoiseScheduler(BaseNoiseScheduler):
@@ -773,25 +995,21 @@ class CosineNoiseScheduler(BaseNoiseScheduler):
         """
         return torch.cos((t / self.noise_time_steps + self.s) / (1 + self.s) * torch.pi / 2) ** 2
 
+    @torch.no_grad()
     def _initialize_schedule(self):
         """
         Initializes the schedule for alpha and beta values based on the cosine schedule.
         """
         t = torch.linspace(0, self.noise_time_steps, self.noise_time_steps, dtype=torch.float64)
-        self.alpha_bar = self._cosine_schedule(t) / self._cosine_schedule(torch.tensor(0.0, dtype=torch.float64))
+        alpha_bar = self._cosine_schedule(t) / self._cosine_schedule(torch.tensor(0.0, dtype=torch.float64))
 
-        self.alphas = torch.ones_like(self.alpha_bar)
-        self.alphas[1:] = self.alpha_bar[1:] / self.alpha_bar[:-1]
-        self.alphas[0] = self.alpha_bar[0]
+        alphas = torch.ones_like(alpha_bar)
+        alphas[1:] = alpha_bar[1:] / alpha_bar[:-1]
+        alphas[0] = alpha_bar[0]
 
-        self.betas = torch.clamp(1 - self.alphas, 0.0001, 0.999)
+        betas = torch.clamp(1 - alphas, 0.0001, 0.999)
 
-        shape = [-1] + [1] * self.num_dims_to_add
-        self.betas = self.betas.view(*shape)
-        self.alphas = self.alphas.view(*shape)
-        self.alpha_bar = self.alpha_bar.view(*shape)
-        self.sqrt_alpha_bar = torch.sqrt(self.alpha_bar)
-        self.sqrt_one_minus_alpha_bar = torch.sqrt(1 - self.alpha_bar)
+        self._set_schedule(betas, alphas, alpha_bar)
 
 
 class Probabilities:
@@ -800,86 +1018,118 @@ class Probabilities:
     of features with different number of values
     """
 
-    def __init__(self, structure: list | tuple, dtype=np.float64):  # todo rename n_values -> structure
+    def __init__(self, structure: list | tuple, dtype=np.float64, debug=False):  # todo rename n_values -> structure
         self.structure = structure
         self.n = len(structure)
         self.length = sum(structure)
         self.dtype = dtype
-        self.mat = None
-        self._set_mat()
-
-    def _set_mat(self):
-        """Create binary masks that divide the various features"""
-        self.mat = np.zeros((self.length, self.length), dtype=self.dtype)
-        for i in range(self.n):
-            start = sum(self.structure[:i])
-            for j in range(self.structure[i]):
-                self.mat[start:start + j + 1, start:start + self.structure[i]] = 1
+        # check for zero sums in normalize, off by default because it scans (and synchronizes) every call
+        self._debug = debug
+        # first column of each feature, used to sum the probabilities of each feature
+        self.starts = np.cumsum([0] + list(structure[:-1]))
+        # feature index of each column, used to expand per-feature arrays to the columns
+        self.expand_idx = np.repeat(np.arange(self.n), structure)
+        # same index for torch tensors, also used to normalize them without numpy
+        self.seg_ids = torch.from_numpy(self.expand_idx)
+        # first column of each feature, used to build the one-hot encoding of torch tensors
+        self.offsets = torch.cumsum(torch.tensor([0] + list(structure[:-1])), dim=0)
+        # column of each value in a (n, max(structure)) padded layout, used by the segmented argmax
+        self.max_values = max(structure)
+        self.pad_idx = self.expand_idx * self.max_values + np.arange(self.length) - self.starts[self.expand_idx]
 
     def normalize(self, p: np.array):
         """Cap at 0, then normalize the probabilities for each feature"""
         assert len(p.shape) == 2, f'{len(p.shape)} != 2'
         assert p.shape[1] == self.length, f'{p.shape[1]} != {self.length}'
-        p = np.maximum(0, p)
-        s = np.dot(p, self.mat)
-        assert np.all(s > 0), f'Zero sum: p={p}, s={s}'
-        return p / s
+        if isinstance(p, torch.Tensor):
+            return self._normalize_tensor(p)
+        # the clamped copy is divided in place, the sums are checked once per feature
+        p = np.maximum(0., p)
+        s = np.add.reduceat(p, self.starts, axis=1)
+        if __debug__ and self._debug:
+            assert np.all(s > 0), f'Zero sum: p={p}, s={s}'
+        np.maximum(s, 1e-12, out=s)
+        p /= s[:, self.expand_idx]
+        return p
+
+    def _normalize_tensor(self, p: torch.Tensor):
+        """Same as normalize, computed with torch on the device of p"""
+        p = torch.clamp(p, min=0)
+        seg_ids = self.seg_ids.to(p.device)
+        s = torch.zeros((p.shape[0], self.n), dtype=p.dtype, device=p.device).index_add_(1, seg_ids, p)
+        if __debug__ and self._debug:
+            assert torch.all(s > 0), f'Zero sum: p={p}, s={s}'
+        s.clamp_min_(1e-12)
+        return p / s[:, seg_ids]
 
     def to_onehot(self, x: np.array):
         """Convert the original values to one-hot encoding"""
         assert len(x.shape) == 2, f'{len(x.shape)} != 2'
         assert x.shape[1] == self.n, f'{x.shape[1]} != {self.n}'
+        if isinstance(x, torch.Tensor):
+            return self._to_onehot_tensor(x)
         # check that each value of x is less than the number of values for that feature
         assert np.all(np.max(x, axis=0) < self.structure), f'Values out of range'
         # check that values are positive
         assert np.all(x >= 0), f'Negative values'
 
+        # all the features are set with a single scatter, each one is shifted to its columns
         x1 = np.zeros((x.shape[0], self.length), dtype=np.float64)
-        start = 0
-        for i in range(self.n):
-            x1[np.arange(x.shape[0]), x[:, i] + start] = 1
-            start += self.structure[i]
+        cols = x + self.starts
+        rows = np.broadcast_to(np.arange(x.shape[0])[:, None], cols.shape)
+        x1[rows.ravel(), cols.ravel()] = 1
         return x1
 
+    def _to_onehot_tensor(self, x: torch.Tensor):
+        """Same as to_onehot, computed with torch on the device of x"""
+        assert torch.all(x < torch.tensor(self.structure, device=x.device)), f'Values out of range'
+        assert torch.all(x >= 0), f'Negative values'
+        # the ones of all the features are written with a single scatter, each one is shifted to its columns
+        x1 = torch.zeros((x.shape[0], self.length), dtype=torch.get_default_dtype(), device=x.device)
+        return x1.scatter_(1, x.long() + self.offsets.to(x.device), 1.)
+
     def onehot_to_values(self, x: np.array):
         """Return the original values from the one-hot encoding"""
         assert len(x.shape) == 2, f'{len(x.shape)} != 2'
         assert x.shape[1] == self.length, f'{x.shape[1]} != {self.length}'
-        x1 = np.zeros((x.shape[0], self.n), dtype=np.int64)
-        start = 0
-        for i in range(self.n):
-            x1[:, i] = np.argmax(x[:, start:start + self.structure[i]], axis=1)
-            start += self.structure[i]
-        return x1
+        # the features are padded with -inf to the same number of values, then a single argmax is taken
+        padded = np.full((x.shape[0], self.n * self.max_values), -np.inf)
+        padded[:, self.pad_idx] = np.asarray(x)
+        return np.argmax(padded.reshape(x.shape[0], self.n, self.max_values), axis=2)
 
     def prob_to_onehot(self, p: np.array):
         """Convert the probabilities to one-hot encoding"""
         assert len(p.shape) == 2, f'{len(p.shape)} != 2'
         assert p.shape[1] == self.length, f'{p.shape[1]} != {self.length}'
-        x = np.zeros((p.shape[0], self.n), dtype=np.int64)
-        start = 0
-        for i in range(self.n):
-            x[:, i] = np.argmax(p[:, start:start + self.structure[i]], axis=1)
-            start += self.structure[i]
-        return self.to_onehot(x)
+        return self.to_onehot(self.onehot_to_values(p))
     
-    def add_noise(self, p: np.array, k=1.):
-        """Add noise to the probabilities"""
+    def add_noise(self, p: np.array, k=1., n=1):
+        """Add noise to the probabilities
+        If n > 1, n noisy copies of p are stacked along the first dimension
+        """
         assert len(p.shape) == 2, f'{len(p.shape)} != 2'
         assert p.shape[1] == self.length, f'{p.shape[1]} != {self.length}'
+        if isinstance(p, torch.Tensor):
+            p = p.repeat(n, 1)
+            return self.normalize(p + torch.rand(p.shape, dtype=p.dtype, device=p.device) * k)
+        p = np.tile(p, (n, 1))
         return self.normalize(p + np.random.random(p.shape) * k)
 
     def _logits_to_normalized_probs(self, logits):
-        """Convert logits to normalized probabilities"""
+        """Convert logits to normalized probabilities with a softmax over each feature
+        The maximum of each feature is subtracted before the exponential, so it does not overflow or underflow
+        """
         assert isinstance(logits, np.ndarray), 'logits must be a numpy array'
-        p = 1 / (1 + np.exp(-logits))
-        return self.normalize(p)
+        z = logits - np.maximum.reduceat(logits, self.starts, axis=1)[:, self.expand_idx]
+        p = np.exp(z)
+        return p / np.add.reduceat(p, self.starts, axis=1)[:, self.expand_idx]
     
     def prob_to_values(self, p):
         """Convert probabilities to values"""
         if isinstance(p, torch.Tensor):
             p = p.numpy()
-        return self.onehot_to_values(self.prob_to_onehot(self.normalize(p)))
+        # the normalization and the one-hot round trip do not change the argmax of each feature
+        return self.onehot_to_values(np.maximum(0, p))
 
     def logits_to_proba(self, logits):
         """Convert logits to probabilities"""
@@ -891,13 +1141,16 @@ class Probabilities:
         """Convert logits to values"""
         if isinstance(logits, torch.Tensor):
             logits = logits.numpy()
-        p = self._logits_to_normalized_probs(logits)
-        return self.onehot_to_values(self.prob_to_onehot(p))
+        # the softmax of each feature is monotonic, so the values are the argmax of the logits
+        return self.onehot_to_values(logits)
     
     def values_to_logits(self, values, epsilon=1e-6):
         """Convert values to logits"""
         p = self.to_onehot(values)
-        return np.log((p + epsilon) / (1 - p + epsilon))
+        # p is one-hot, so the logits only take two values
+        log_hi = np.log((1 + epsilon) / epsilon)
+        log_lo = np.log(epsilon / (1 + epsilon))
+        return np.where(p > 0, log_hi, log_lo)
 
 
 class bcolors:
@@ -940,83 +1193,66 @@ def plot_agreement_disagreement_transformation(array1, array2, filename, save_lo
     assert array1.dtype == bool and array2.dtype == bool, "Inputs must be boolean arrays"
     assert len(array1) == len(array2), "Arrays must be of the same length"
 
-    # Identify agreement and disagreement
-    agree = array1 == array2
-    disagree = ~agree
-
-    # Identify proper transformations (True in array1 to False in array2)
-    proper_transformed = (array1 & ~array2)
-    # Identify wrong transformations (False in array1 to True in array2)
-    wrong_transformed = (~array1 & array2)
-
-    # Create the plot with higher DPI
-    plt.figure(figsize=(30, 7), dpi=300)
-
-    y_ticks = np.array([1, 2, 3, 4, 5])
-    pm = 0.1
-
-    # Plot array1 representation
-    plt.vlines(np.where(array1)[0], y_ticks[4] - pm, y_ticks[4] + pm, color='c', label='Orig.: T')
-    plt.vlines(np.where(~array1)[0], y_ticks[4] - pm, y_ticks[4] + pm, color='y', label='Orig.: F')
-
-    # Plot array2 representation
-    plt.vlines(np.where(array2)[0], y_ticks[3] - pm, y_ticks[3] + pm, color='b', label='Trans.: T')
-    plt.vlines(np.where(~array2)[0], y_ticks[3] - pm, y_ticks[3] + pm, color='m', label='Trans.: F')
-
-    # Plot agreement
-    plt.vlines(np.where(agree)[0], y_ticks[2] - pm, y_ticks[2] + pm, color='g', label='Agree')
-
-    # Plot disagreement
-    plt.vlines(np.where(disagree)[0], y_ticks[2] - pm, y_ticks[2] + pm, color='r', label='Disagree')
-
-    # Plot proper transformations
-    plt.vlines(np.where(wrong_transformed)[0], y_ticks[1] - pm, y_ticks[1] + pm, color='b', label='x Trans. (F to T)')
-
-    # Plot wrong transformations
-    plt.vlines(np.where(proper_transformed)[0], y_ticks[0] - pm, y_ticks[0] + pm, color='m', label='✓ Trans. (T to T)')
-
-    # Add grid and labels
-    plt.yticks(y_ticks, ['', '', '', '', ''])
-    plt.xlabel('Index')
-    plt.title('Agreement, Disagreement, and Transformation between Two Boolean Arrays')
-    plt.legend(bbox_to_anchor=(1.005, 1), loc='upper left')
-    plt.grid(True, which='both', linestyle='--', linewidth=0.5)
-
-    # Remove x and y ticks
-    plt.xticks([])
+    # Classify each position in a single pass, code = 2 * array1 + array2
+    code = (array1.view(np.uint8) << 1) | array2.view(np.uint8)
+
+    # Color of each row for each code (FF, FT, TF, TT), 0 is the background
+    colors = ['w', 'c', 'y', 'b', 'm', 'g', 'r']
+    rows_lut = np.array([
+        [2, 2, 1, 1],  # array1: Orig. T (c) / F (y)
+        [4, 3, 4, 3],  # array2: Trans. T (b) / F (m)
+        [5, 6, 6, 5],  # agreement (g) / disagreement (r)
+        [0, 3, 0, 0],  # wrong transformations, False in array1 to True in array2 (b)
+        [0, 0, 4, 0],  # proper transformations, True in array1 to False in array2 (m)
+    ], dtype=np.uint8)
+
+    # One image with a row per representation, instead of a vertical line per index
+    img = rows_lut[:, code]
+    fig, ax = _reusable_figure('plot_agreement_disagreement_transformation', figsize=(30, 7))
+    ax.imshow(img, aspect='auto', interpolation='nearest', cmap=ListedColormap(colors),
+              vmin=0, vmax=len(colors) - 1, extent=(-0.5, len(code) - 0.5, 4.5, -0.5))
+
+    labels = {'c': 'Orig.: T', 'y': 'Orig.: F', 'b': 'Trans.: T', 'm': 'Trans.: F', 'g': 'Agree', 'r': 'Disagree'}
+    handles = [Patch(color=color, label=label) for color, label in labels.items()]
+    handles += [Patch(color='b', label='x Trans. (F to T)'), Patch(color='m', label='✓ Trans. (T to T)')]
+
+    # Add labels and remove the ticks
+    ax.set_yticks([])
+    ax.set_xticks([])
+    ax.set_xlabel('Index')
+    ax.set_title('Agreement, Disagreement, and Transformation between Two Boolean Arrays')
+    ax.legend(handles=handles, bbox_to_anchor=(1.005, 1), loc='upper left')
 
     # Save the plot locally
     if save_locally:
-        plt.savefig(path + filename + '.png')
+        fig.savefig(path + filename + '.png', dpi=100)
 
     # Save the plot to wandb
-    wandb.log({filename: wandb.Image(plt)})
+    wandb.log({filename: wandb.Image(fig)})
 
 
 def plot_categories(label_values, n_values, filename, save_locally=False, save_wandb=False, path="../plots/"):
     if isinstance(label_values, torch.Tensor):
         label_values = label_values.numpy()
 
-    data = pd.DataFrame(label_values, columns=[f'Category {i}' for i in range(len(n_values))])
-
-    # Melt the dataframe to have a long format suitable for seaborn
-    melted_data = data.melt(var_name='Category', value_name='Value')
+    columns = [f'Category {i}' for i in range(len(n_values))]
 
     # Create a figure with subplots for each category
     fig, axs = plt.subplots(1, len(n_values), figsize=(30, 6), sharey=True)
 
-    # Get the maximum number of unique values in all categories
-    max_unique_values = max(data.nunique())
+    # Get the number of unique values in each category and the maximum over all categories
+    n_unique = [len(np.unique(label_values[:, i])) for i in range(len(columns))]
+    max_unique_values = max(n_unique)
 
     # Iterate over each category
-    for i, category in enumerate(data.columns):
-        # Create the bar plot for the current category
-        ax = sns.countplot(data=melted_data[melted_data['Category'] == category], x='Category', hue='Value', ax=axs[i])
+    for i, category in enumerate(columns):
+        # Create the bar plot for the current category, directly from its column
+        ax = sns.countplot(x=np.full(len(label_values), category), hue=label_values[:, i], ax=axs[i])
 
         # Adjust the width of the bars according to the number of unique values in the category
         for patch in ax.patches:
             current_width = patch.get_width()
-            diff = current_width - (current_width * data[category].nunique() / max_unique_values)
+            diff = current_width - (current_width * n_unique[i] / max_unique_values)
             patch.set_width(current_width - diff)
 
         # Adding labels and title
@@ -1056,63 +1292,64 @@ def element_wise_label_values_comparison(input, output, mask):
     if isinstance(mask, torch.Tensor):
         mask = mask.numpy().astype(bool)
 
-    num_rows_differ = 0
-    total_wrongly_changed_values = 0
-    known_values = 0
-
-    for row_input, row_output, row_mask in zip(input, output, mask):
-        # Apply the mask to the current row
-        masked_input = row_input[~row_mask]
-        masked_output = row_output[~row_mask]
+    # values that should not have changed according to the mask, and that were changed
+    known = ~mask
+    wrongly_changed = (input != output) & known
 
-        # Compare the masked arrays element-wise
-        element_wise_comparison = masked_input != masked_output
+    num_rows_differ = int(np.count_nonzero(np.any(wrongly_changed, axis=1)))
+    known_values = int(np.count_nonzero(known))
+    total_wrongly_changed_values = int(np.count_nonzero(wrongly_changed))
 
-        # Calculate the total number of values wrongly changed for this row
-        row_wrongly_changed_values = np.sum(element_wise_comparison)
-
-        # Update the total wrongly changed values
-        total_wrongly_changed_values += row_wrongly_changed_values
-
-        # Update the total number of values that should not have changed according to the mask
-        row_known_values = np.sum(~row_mask)
-        known_values += row_known_values
+    return num_rows_differ, known_values, total_wrongly_changed_values
 
-        # Determine if there are differences within the masked input for this row
-        if np.any(element_wise_comparison):
-            num_rows_differ += 1
 
-    return num_rows_differ, known_values, total_wrongly_changed_values
+@torch.jit.script
+def binary_accuracy(y_pred: torch.Tensor, y: torch.Tensor, threshold: float = 0.):
+    """
+    Fraction of the predictions above the threshold that agree with the binary labels y,
+    the comparison, the cast and the mean are fused in one scripted kernel.
+    The default threshold is for logits, a logit > 0 is a probability > 0.5
+    """
+    return ((y_pred > threshold).to(y.dtype) == y).to(torch.float32).mean()
 
 
 class ClassificationModel:
     """
-    Example classifier
+    Example classifier, it outputs logits
     """
 
     def __init__(self):
         self.model = None
+        # arguments of reset, they are saved with the parameters to rebuild the model
+        self.config = None
         
     def load_model_pickle(self, filename, path="../models/"):
-        """Load model parameters from a file using pickle."""
+        """Load model parameters from a file using pickle.
+        The file holds the state dict and the config of the model, so only tensors are unpickled.
+        """
         print(f'Loading a classifier model...')
         try:
-            model = torch.load(path + filename + '.pkl')
-            self.model = model
+            checkpoint = torch.load(path + filename + '.pkl', weights_only=True)
+            self.reset(**checkpoint['config'])
+            self.model.load_state_dict(checkpoint['state_dict'])
         except FileNotFoundError:
             print('Model not found')
             self.model = None
+        except pickle.UnpicklingError:
+            # a whole pickled module may end with a Sigmoid, its outputs are not logits
+            print('Model saved in an old format, it is not loaded')
+            self.model = None
 
     def __call__(self, *args, **kwargs):
         return self.model(*args, **kwargs)
 
     def reset(self, input_size, hidden):
         print(f'Creating a new classifier model...')
+        self.config = {'input_size': input_size, 'hidden': hidden}
         self.model = nn.Sequential(
             nn.Linear(input_size, hidden),
             nn.Softplus(),
-            nn.Linear(hidden, 1),
-            nn.Sigmoid()
+            nn.Linear(hidden, 1)
         )
         # self.model = nn.Sequential(
         #     nn.Linear(input_size, hidden),
@@ -1131,8 +1368,8 @@ class ClassificationModel:
     def _training_loop(self, dataloader, n_epochs, learning_rate, weight_decay):
         # use the AdamW optimizer
         optimizer = optim.AdamW(self.model.parameters(), lr=learning_rate, weight_decay=weight_decay)
-        # use the Binary Cross Entropy loss
-        criterion = nn.BCELoss()
+        # use the Binary Cross Entropy loss, computed from the logits
+        criterion = nn.BCEWithLogitsLoss()
         
         pbar = tqdm(range(n_epochs))
         for epoch in pbar:
@@ -1161,13 +1398,13 @@ class ClassificationModel:
         x = dataloader.dataset.dataset.tensors[0]
         y = dataloader.dataset.dataset.tensors[1]
         # test the model
-        y_pred = self.model(x)
+        self.model.eval()
+        with torch.no_grad():
+            y_pred = self.model(x)
 
-        # performance metrics
-        y_class = (y_pred > 0.5).float()
-        accuracy = np.array(y_class == y).astype(float).mean()
+        # performance metrics, a logit > 0 is a probability > 0.5
+        acc = binary_accuracy(y_pred, y).item()
         dummy_acc = max(y.mean().item(), 1 - y.mean().item())
-        acc = accuracy.item()
         usefulness = max([0, (acc - dummy_acc) / (1 - dummy_acc)])
         print(f'Dummy accuracy = {dummy_acc:.1%}')
         print(f'Accuracy = {acc:.1%}')
@@ -1176,7 +1413,7 @@ class ClassificationModel:
         if not os.path.exists(path):
             os.makedirs(path)
             # save the model
-        torch.save(self.model, path + model_name + '.pkl')
+        torch.save({'state_dict': self.model.state_dict(), 'config': self.config}, path + model_name + '.pkl')
         
 
 def compute_arrays_agreements(array1, array2):
@@ -1186,12 +1423,15 @@ def compute_arrays_agreements(array1, array2):
         array2 = array2.numpy().astype(int)
     
     # Compute the number of columns they agree on per row
-    agreements_per_row = np.sum(array1 == array2, axis=1)
+    agreements_per_row = np.count_nonzero(array1 == array2, axis=1)
 
     # Calculate the mean, median, and standard deviation of these values
     mean_agreements = np.mean(agreements_per_row)
-    median_agreements = np.median(agreements_per_row)
     std_agreements = np.std(agreements_per_row)
+    # the median only needs the middle elements in place, not a full sort
+    n = len(agreements_per_row)
+    middle = np.partition(agreements_per_row, [(n - 1) // 2, n // 2])
+    median_agreements = (middle[(n - 1) // 2] + middle[n // 2]) / 2
 
     results = {
         "mean": mean_agreements,
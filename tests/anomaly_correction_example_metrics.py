@@ -1,42 +1,53 @@
 import sys
 import os
+import pickle
+import socket
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import torch
+import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import pandas as pd
 import numpy as np
-from tqdm import tqdm
-import io
-import contextlib
-from functools import wraps
-from src.utils import cprint, bcolors, plot_loss
+import logging
+from src.utils import cprint, bcolors, plot_loss, binary_accuracy, train_classifier
 from src.denoising_diffusion_pm import DDPMAnomalyCorrection as Diffusion
 from src.anomaly_correction import AnomalyCorrection
 
-# set default type to avoid problems with gradient
-DEFAULT_TYPE = torch.float64
+# single precision is enough for the gradient and it is the fast path on the GPU
+DEFAULT_TYPE = torch.float32
 torch.set_default_dtype(DEFAULT_TYPE)
+DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
 class ClassificationModel:
     """
-    Example classifier
+    Example classifier, it outputs logits
     """
-
-    def __init__(self):
+    def __init__(self, device=DEVICE):
         self.model = None
+        self.device = device
+        # arguments of reset, they are saved with the parameters to rebuild the model
+        self.config = None
 
     def load_from_file(self, model_path):
         """
         Set the model if the pkl file is found.
+        The file holds the state dict and the config of the model, so only tensors are unpickled.
         If a file is not found, then the model remains None
         """
         if os.path.exists(model_path):
             try:
                 cprint(f'Loading model from {model_path}', bcolors.WARNING)
-                self.model = torch.load(model_path)
+                checkpoint = torch.load(model_path, map_location=self.device, weights_only=True)
+                self.reset(**checkpoint['config'])
+                self.model.load_state_dict(checkpoint['state_dict'])
                 cprint('Model loaded', bcolors.OKGREEN)
             except FileNotFoundError:
                 cprint('Model not found', bcolors.FAIL)
+            except pickle.UnpicklingError:
+                # a whole pickled module may end with a Sigmoid, its outputs are not logits
+                cprint('Model saved in an old format, it is not loaded', bcolors.FAIL)
 
     def __call__(self, *args, **kwargs):
         return self.model(*args, **kwargs)
@@ -45,55 +56,40 @@ class ClassificationModel:
         """ Create the model """
         print(f'Input size: {input_size}')
         cprint('Creating model', bcolors.WARNING)
+        self.config = {'input_size': input_size, 'hidden': hidden}
         self.model = torch.nn.Sequential(
             torch.nn.Linear(input_size, hidden),
             torch.nn.Softplus(),
-            torch.nn.Linear(hidden, 1),
-            torch.nn.Sigmoid()
-        )
-
-    def _training_loop(self, num_samples, optimizer, n_epochs, batch_size, x, y, loss_fn):
-
-        for epoch in range(n_epochs):
-            total_loss = 0.0
-            for i in range(0, num_samples, batch_size):
-                batch_x = x[i:i + batch_size]
-                batch_y = y[i:i + batch_size]
-
-                y_pred = self.model(batch_x)
-                loss = loss_fn(y_pred, batch_y)
-
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-
-                total_loss += loss.item()
-
-            avg_loss = total_loss / (num_samples / batch_size)
-            print(f'\rEpoch {epoch + 1}, Loss {avg_loss:.6f}', end=' ')
-        print()
-
-    def train(self, x, y, model_path, loss_fn, n_epochs=200, lr=0.1, weight_decay=1e-4,
-              momentum=0.9, nesterov=True, batch_size=100):
-        # optimizer
-        optimizer = torch.optim.SGD(self.model.parameters(), lr=lr,
-                                    weight_decay=weight_decay, momentum=momentum,
-                                    nesterov=nesterov)
+            torch.nn.Linear(hidden, 1)
+        ).to(self.device)
+
+    def train(self, x, y, model_path, loss_fn, n_epochs=200, lr=0.01, weight_decay=1e-4,
+              momentum=0.9, nesterov=True, batch_size=100, optimizer='adamw'):
+        # optimizer, momentum and nesterov are only used by SGD
+        assert optimizer in ('adamw', 'sgd'), 'The optimizer must be adamw or sgd'
+        if optimizer == 'adamw':
+            # the fused version updates all the parameters in a single kernel, it requires the GPU
+            optimizer = torch.optim.AdamW(self.model.parameters(), lr=lr, weight_decay=weight_decay,
+                                          fused=self.device.type == 'cuda')
+        else:
+            optimizer = torch.optim.SGD(self.model.parameters(), lr=lr,
+                                        weight_decay=weight_decay, momentum=momentum,
+                                        nesterov=nesterov)
 
-        # Training loop
-        num_samples = x.shape[0]
-        self._training_loop(num_samples, optimizer, n_epochs, batch_size, x, y, loss_fn)
+        # Training loop, the data already lives on the device
+        train_classifier(self.model, x, y, optimizer, loss_fn, n_epochs, batch_size=batch_size)
 
         # test the model
-        y_pred = self.model(x)
+        with torch.no_grad():
+            y_pred = self.model(x)
         loss = loss_fn(y_pred, y)
         print(f'Final Loss {loss.item():.6f}')
 
         # performance metrics
-        y_class = (y_pred > 0.5).float()
-        accuracy = np.array(y_class == y).astype(float).mean()
-        dummy_acc = max(y.mean().item(), 1 - y.mean().item())
-        acc = accuracy.item()
+        # computed with torch on the device, each metric is synchronized once
+        acc = binary_accuracy(y_pred, y).item()
+        y_mean = y.mean().item()
+        dummy_acc = max(y_mean, 1 - y_mean)
         usefulness = max([0, (acc - dummy_acc) / (1 - dummy_acc)])
         if usefulness > 0.75:
             color = bcolors.OKGREEN
@@ -104,36 +100,91 @@ class ClassificationModel:
         print(f'Dummy accuracy = {dummy_acc:.1%}')
         print(f'Accuracy on test data = {acc:.1%}')
         cprint(f'usefulness = {usefulness:.1%}', color)
-        rmse = torch.sqrt(torch.mean((y_pred - y) ** 2))
+        rmse = F.mse_loss(torch.sigmoid(y_pred), y).sqrt()
         print(f'RMSE on test data {rmse.item():.3f}')
 
         # save the model
-        torch.save(self.model, model_path)
+        torch.save({'state_dict': self.model.state_dict(), 'config': self.config}, model_path)
         cprint('Model saved', bcolors.OKGREEN)
 
-def suppress_print(func):
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        # Capture stdout
-        with io.StringIO() as buf, contextlib.redirect_stdout(buf):
-            # Capture stderr (used by tqdm)
-            with io.StringIO() as buf_err, contextlib.redirect_stderr(buf_err):
-                result = func(*args, **kwargs)
-                output = buf.getvalue()
-                error_output = buf_err.getvalue()
-        return result #, output, error_output
-    return wrapper
+
+def train_diffusion(diffusion, data_diff_x, proba, diffusion_model_name, compile_model=False, amp=False,
+                    distributed=False):
+    """
+    Create and train the diffusion model, then save it.
+    With distributed, only the process with rank 0 plots the data and saves the model
+    """
+    dataset_shape = diffusion.dataset_shape
+    main_process = not distributed or dist.get_rank() == 0
+    diffusion.set_model(time_dim_emb=64,
+                        concat_x_and_t=True,
+                        feed_forward_kernel=True,
+                        hidden_units=[2 * dataset_shape[1],
+                                      3 * dataset_shape[1],
+                                      3 * dataset_shape[1],
+                                      2 * dataset_shape[1],
+                                      2 * dataset_shape[1]
+                                      ],
+                        unet=False)
+    # DDPM training
+    train_losses = diffusion.train(data_diff_x,
+                                   batch_size=16,
+                                   learning_rate=1e-3,
+                                   epochs=100,
+                                   beta_ema=0.999,
+                                   plot_data=main_process,
+                                   proba=proba,
+                                   original_data_name='ddpm_original_data',
+                                   compile_model=compile_model,
+                                   amp=amp,
+                                   distributed=distributed)
+    loss_name = 'ddpm_loss'
+
+    if main_process:
+        plot_loss(train_losses, loss_name, save_locally=True)
+        diffusion.save_model_pickle(filename=diffusion_model_name,
+                                    ema_model=True)
+
+
+def _free_port():
+    """ A free TCP port of this machine, for the process group of the distributed training """
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def _diffusion_worker(rank, world_size, port, dataset_shape, data_diff_x, proba, diffusion_model_name, amp):
+    """ Train the diffusion model in one of the processes of the distributed training """
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ['MASTER_PORT'] = port
+    if torch.cuda.is_available():
+        torch.cuda.set_device(rank)
+    dist.init_process_group('nccl' if torch.cuda.is_available() else 'gloo', rank=rank, world_size=world_size)
+
+    diffusion = Diffusion(dataset_shape=dataset_shape,
+                          noise_time_steps=128)
+    # DistributedDataParallel can't wrap the compiled model
+    train_diffusion(diffusion, data_diff_x, proba, diffusion_model_name, amp=amp, distributed=True)
+
+    dist.destroy_process_group()
 
 
 def main(data_path='../datasets/sum_limit_problem.csv',
          model_path='../models/sum_limit_classifier.pkl',
          diffusion_model_name='sum_limit_diffusion_model.pkl',
-         hidden=30, loss_fn=torch.nn.MSELoss(), n_epochs=250):
+         hidden=30, loss_fn=torch.nn.BCEWithLogitsLoss(), n_epochs=250,
+         world_size=None):
     np.random.seed(42)
+    # by default, the diffusion model is trained on all the GPUs
+    if world_size is None:
+        world_size = torch.cuda.device_count()
+    # the diagnostics of the anomaly correction are not shown
+    logging.getLogger('anomaly').setLevel(logging.WARNING)
 
     # ================================================================================
     # get data
-    df_x = pd.read_csv(data_path)
+    # the labels are read as booleans directly, they are used as a mask
+    df_x = pd.read_csv(data_path, dtype={'anomaly': bool})
     df_x = df_x.sample(frac=1).reset_index(drop=True)
     df_y = df_x.copy()['anomaly']
     del df_x['anomaly']
@@ -144,14 +195,17 @@ def main(data_path='../datasets/sum_limit_problem.csv',
     # print('\nNoisy probabilities:')
     # print(np.round(anomaly_correction.p_data_noisy, 2))
     # print('\nValue maps:')
-    # for key in anomaly_correction.get_value_maps():
-    #     print(f'{key}: {anomaly_correction.get_value_maps()[key]}')
+    # for key, value_map in anomaly_correction.get_value_maps().items():
+    #     print(f'{key}: {value_map}')
 
     # ================================================================================
     # The classification model
+    # the model and the data are moved to the device once, before the training loop
     data_x, data_y = anomaly_correction.get_classification_dataset()
+    data_x = data_x.to(DEVICE, non_blocking=True)
+    data_y = data_y.to(DEVICE, non_blocking=True)
 
-    classification_model = ClassificationModel()
+    classification_model = ClassificationModel(device=DEVICE)
     classification_model.load_from_file(model_path)
 
     if classification_model.model is None:
@@ -159,7 +213,7 @@ def main(data_path='../datasets/sum_limit_problem.csv',
         classification_model.train(data_x, data_y,
                                    model_path, loss_fn, n_epochs=n_epochs)
 
-    anomaly_correction.set_classification_model(classification_model)
+    anomaly_correction.set_classification_model(classification_model, from_logits=True)
 
     # ================================================================================
     # The diffusion model
@@ -177,85 +231,78 @@ def main(data_path='../datasets/sum_limit_problem.csv',
 
     diffusion.load_model_pickle(diffusion_model_name)  # !name, NOT PATH
 
-    if diffusion.model is None:
-        diffusion.set_model(time_dim_emb=64,
-                            concat_x_and_t=True,
-                            feed_forward_kernel=True,
-                            hidden_units=[2 * dataset_shape[1],
-                                          3 * dataset_shape[1],
-                                          3 * dataset_shape[1],
-                                          2 * dataset_shape[1],
-                                          2 * dataset_shape[1]
-                                          ],
-                            unet=False)
-        # DDPM training
-        train_losses = diffusion.train(data_diff_x,
-                                       batch_size=16,
-                                       learning_rate=1e-3,
-                                       epochs=100,
-                                       beta_ema=0.999,
-                                       plot_data=True,
-                                       proba=anomaly_correction.proba,
-                                       original_data_name='ddpm_original_data')
-        loss_name = 'ddpm_loss'
+    # the compiled model (with CUDA graphs) pays off on the GPU, on the CPU the eager model is used
+    compile_model = DEVICE.type == 'cuda'
+    # bfloat16 autocast where the tensor cores support it, the parameters stay in float32
+    amp = compile_model and torch.cuda.is_bf16_supported()
 
-        plot_loss(train_losses, loss_name, save_locally=True)
-        diffusion.save_model_pickle(filename=diffusion_model_name,
-                                    ema_model=True)
+    if diffusion.model is None:
+        if world_size > 1:
+            # one process per GPU, the model saved by the first process is loaded back,
+            # the port is taken from MASTER_PORT or a free one is picked, so concurrent runs don't collide
+            port = os.environ.get('MASTER_PORT') or str(_free_port())
+            mp.spawn(_diffusion_worker,
+                     args=(world_size, port, dataset_shape, data_diff_x, anomaly_correction.proba,
+                           diffusion_model_name, amp),
+                     nprocs=world_size)
+            diffusion.load_model_pickle(diffusion_model_name)
+        else:
+            train_diffusion(diffusion, data_diff_x, anomaly_correction.proba, diffusion_model_name,
+                            compile_model=compile_model, amp=amp)
 
     anomaly_correction.set_diffusion(diffusion)
 
-    diffusion.sample(num_samples=1000,
-                     classifier=classification_model,
-                     plot_data=True,
-                     proba=anomaly_correction.proba,
-                     sampled_data_name='ddpm_sampled_data')
+    # no autograd bookkeeping is needed to sample and classify the samples
+    with torch.inference_mode():
+        diffusion.sample(num_samples=1000,
+                         classifier=classification_model,
+                         from_logits=True,
+                         compile_model=compile_model,
+                         amp=amp,
+                         plot_data=True,
+                         proba=anomaly_correction.proba,
+                         sampled_data_name='ddpm_sampled_data')
+
+    # positions of the anomalies, the dataframe is not masked and copied at every selection
+    anomaly_idx = np.flatnonzero(df_y.to_numpy())
 
     # # ================================================================================
     # # pick some anomalies
-    # anomaly = df_x[df_y == 1].sample(1)
+    # anomaly = df_x.iloc[np.random.choice(anomaly_idx, 1)]
     # print('\nAnomaly:')
     # print(anomaly)
     # print(type(anomaly))
 
     # # ================================================================================
     # # run the anomaly-correction algorithm
-    # corrected_anomaly = suppress_print(anomaly_correction.correct_anomaly)(anomaly, n=10)
+    # corrected_anomaly = anomaly_correction.correct_anomaly(anomaly, n=10)
     # print('\nCorrected anomaly:')
     # print(corrected_anomaly)
     
     # stop the code execution here
     # return
     
-    anomalies = df_x[df_y == 1]
-    
-    corrected_anomalies = []
-    pbar = tqdm(range(anomalies.shape[0]))
-    for i in pbar:
-        anomaly = anomalies.iloc[i, :].to_frame().transpose()
-
-        print(f'\nAnomaly {i}:')
-        print(anomaly)
+    anomalies = df_x.iloc[anomaly_idx[:3]]
+    print('\nAnomalies:')
+    print(anomalies)
 
-        corrected_anomaly = anomaly_correction.correct_anomaly(anomaly, n=10)
-        corrected_anomalies.append(corrected_anomaly)
-        if i == 2:
-            pbar.close()  # Close the display of the progress bar
-            break
+    # all the anomalies are corrected in a single batch
+    corrected_anomalies = anomaly_correction.correct_anomalies(anomalies, n=10)
 
     print('\nCoorrected anomalies Inverse Gradient:')
     
     # print the first elements in each entry of the list
     print(len(corrected_anomalies))
-    print(corrected_anomalies[0].iloc[0, :].to_frame().transpose())
-    print(corrected_anomalies[1].iloc[0, :].to_frame().transpose().values)
-    print(corrected_anomalies[2].iloc[0, :].to_frame().transpose().values)
+    print(corrected_anomalies[0].iloc[[0]])
+    print(corrected_anomalies[1].iloc[[0]].values)
+    print(corrected_anomalies[2].iloc[[0]].values)
     
-    # Extract the rows
-    corrected_anomalies_per_mask = [[df.iloc[i].tolist() for df in corrected_anomalies] for i in range(len(corrected_anomalies[0]))] 
+    # Stack the corrections with shape (n_masks, n_anomalies, n_features)
+    corrected_values = np.stack([df.to_numpy() for df in corrected_anomalies], axis=1)
 
-    # Convert the list of lists to a list of dataframes
-    corrected_anomalies_per_mask = [pd.DataFrame(data, columns=corrected_anomalies[0].columns) for data in corrected_anomalies_per_mask]
+    # One dataframe per mask, with a row for each anomaly
+    columns = corrected_anomalies[0].columns
+    corrected_anomalies_per_mask = [pd.DataFrame(values, columns=columns) for values in corrected_values]
     
     print('\nCoorrected anomalies Diffusion Inpainting:')
     print(corrected_anomalies_per_mask[0])
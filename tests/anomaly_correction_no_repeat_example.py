@@ -1,35 +1,46 @@
 import os
+import pickle
 import torch
+import torch.nn.functional as F
 import pandas as pd
 import numpy as np
-from src.utils import cprint, bcolors, plot_loss
+from src.utils import cprint, bcolors, plot_loss, train_classifier
 from src.denoising_diffusion_pm import DDPMAnomalyCorrection as Diffusion
 from src.anomaly_correction import AnomalyCorrection
 
-# set default type to avoid problems with gradient
-DEFAULT_TYPE = torch.float64
+# single precision is enough for the gradient and it is the fast path on the GPU
+DEFAULT_TYPE = torch.float32
 torch.set_default_dtype(DEFAULT_TYPE)
+DEVICE = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
 
 class ClassificationModel:
     """
-    Example classifier
+    Example classifier, it outputs logits
     """
     def __init__(self):
         self.model = None
+        # arguments of reset, they are saved with the parameters to rebuild the model
+        self.config = None
 
     def load_from_file(self, model_path):
         """
         Set the model if the pkl file is found.
+        The file holds the state dict and the config of the model, so only tensors are unpickled.
         If a file is not found, then the model remains None
         """
         if os.path.exists(model_path):
             try:
                 cprint(f'Loading model from {model_path}', bcolors.WARNING)
-                self.model = torch.load(model_path)
+                checkpoint = torch.load(model_path, map_location=DEVICE, weights_only=True)
+                self.reset(**checkpoint['config'])
+                self.model.load_state_dict(checkpoint['state_dict'])
                 cprint('Model loaded', bcolors.OKGREEN)
             except FileNotFoundError:
                 cprint('Model not found', bcolors.FAIL)
+            except pickle.UnpicklingError:
+                # a whole pickled module may end with a Sigmoid, its outputs are not logits
+                cprint('Model saved in an old format, it is not loaded', bcolors.FAIL)
 
     def __call__(self, *args, **kwargs):
         return self.model(*args, **kwargs)
@@ -38,33 +49,12 @@ class ClassificationModel:
         """ Create the model """
         print(f'Input size: {input_size}')
         cprint('Creating model', bcolors.WARNING)
+        self.config = {'input_size': input_size, 'hidden': hidden}
         self.model = torch.nn.Sequential(
             torch.nn.Linear(input_size, hidden),
             torch.nn.Softplus(),
-            torch.nn.Linear(hidden, 1),
-            torch.nn.Sigmoid()
-        )
-
-    def _training_loop(self, num_samples, optimizer, n_epochs, batch_size, x, y, loss_fn):
-
-        for epoch in range(n_epochs):
-            total_loss = 0.0
-            for i in range(0, num_samples, batch_size):
-                batch_x = x[i:i + batch_size]
-                batch_y = y[i:i + batch_size]
-
-                y_pred = self.model(batch_x)
-                loss = loss_fn(y_pred, batch_y)
-
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-
-                total_loss += loss.item()
-
-            avg_loss = total_loss / (num_samples / batch_size)
-            print(f'\rEpoch {epoch + 1}, Loss {avg_loss:.6f}', end=' ')
-        print()
+            torch.nn.Linear(hidden, 1)
+        ).to(DEVICE)
 
     def train(self, x, y, model_path, loss_fn, n_epochs=200, lr=0.1, weight_decay=1e-4,
               momentum=0.9, nesterov=True, batch_size=100):
@@ -74,17 +64,17 @@ class ClassificationModel:
                                     nesterov=nesterov)
 
         # Training loop
-        num_samples = x.shape[0]
-        self._training_loop(num_samples, optimizer, n_epochs, batch_size, x, y, loss_fn)
+        train_classifier(self.model, x, y, optimizer, loss_fn, n_epochs, batch_size=batch_size)
 
         # test the model
-        y_pred = self.model(x)
+        with torch.no_grad():
+            y_pred = self.model(x)
         loss = loss_fn(y_pred, y)
         print(f'Final Loss {loss.item():.6f}')
 
         # performance metrics
-        y_class = (y_pred > 0.5).float()
-        accuracy = np.array(y_class == y).astype(float).mean()
+        y_class = (y_pred > 0).float()
+        accuracy = (y_class == y).float().mean()
         dummy_acc = max(y.mean().item(), 1 - y.mean().item())
         acc = accuracy.item()
         usefulness = max([0, (acc - dummy_acc) / (1 - dummy_acc)])
@@ -97,18 +87,18 @@ class ClassificationModel:
         print(f'Dummy accuracy = {dummy_acc:.1%}')
         print(f'Accuracy on test data = {acc:.1%}')
         cprint(f'usefulness = {usefulness:.1%}', color)
-        rmse = torch.sqrt(torch.mean((y_pred - y) ** 2))
+        rmse = F.mse_loss(torch.sigmoid(y_pred), y).sqrt()
         print(f'RMSE on test data {rmse.item():.3f}')
 
         # save the model
-        torch.save(self.model, model_path)
+        torch.save({'state_dict': self.model.state_dict(), 'config': self.config}, model_path)
         cprint('Model saved', bcolors.OKGREEN)
 
 
 def main(data_path='../datasets/no_repeat_problem.csv',
          model_path='../models/no_repeat_problem_model.pkl',
          ddpm_model_name = 'no_repeat_problem_ddpm_model',
-         hidden=20, loss_fn=torch.nn.MSELoss(),
+         hidden=20, loss_fn=torch.nn.BCEWithLogitsLoss(),
          n_epochs=500, lr=.1,
          correction_step=0.01, correction_n_iter=1000,
          initial_noise=.01, threshold_p=0.1):
@@ -127,8 +117,8 @@ def main(data_path='../datasets/no_repeat_problem.csv',
     print('\nNoisy probabilities:')
     print(np.round(anomaly_correction.p_data_noisy, 2))
     print('\nValue maps:')
-    for key in anomaly_correction.get_value_maps():
-        print(f'{key}: {anomaly_correction.get_value_maps()[key]}')
+    for key, value_map in anomaly_correction.get_value_maps().items():
+        print(f'{key}: {value_map}')
 
     # ================================================================================
     # The classification model
@@ -143,7 +133,7 @@ def main(data_path='../datasets/no_repeat_problem.csv',
                                    model_path, loss_fn,
                                    n_epochs=n_epochs, lr=lr)
 
-    anomaly_correction.set_classification_model(classification_model)
+    anomaly_correction.set_classification_model(classification_model, from_logits=True)
 
     # ================================================================================
     # The diffusion model
@@ -189,6 +179,7 @@ def main(data_path='../datasets/no_repeat_problem.csv',
 
     diffusion.sample(num_samples=1000,
                      classifier=classification_model,
+                     from_logits=True,
                      plot_data=True,
                      proba=anomaly_correction.proba,
                      sampled_data_name='ddpm_sampled_data')
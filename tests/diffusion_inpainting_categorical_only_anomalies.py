@@ -143,7 +143,8 @@ def main_sum_categorical_data():
         classifier.model.eval()
         with torch.no_grad():
             prediction = classifier.model(torch.tensor(sampled_data, dtype=torch.float64))
-            y = np.round(prediction.numpy().flatten())
+            # the classifier outputs logits, a logit > 0 is an anomaly
+            y = (prediction > 0).numpy().flatten()
             percentage_anomalies = y.mean()
         
         print(f"Percentage of anomalies in the generated samples: {percentage_anomalies:.2%}\n")
@@ -182,7 +183,8 @@ def main_sum_categorical_data():
     percentage_anomalies_inpainted_classifier = None
     with torch.no_grad():
         prediction = classifier.model(torch.tensor(inpainted_data, dtype=torch.float64))
-        y = np.round(prediction.numpy().flatten())
+        # the classifier outputs logits, a logit > 0 is an anomaly
+        y = (prediction > 0).numpy().flatten()
         percentage_anomalies_inpainted_classifier = y.mean()
     
     # Count the number of original anomalies